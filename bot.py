@@ -1,41 +1,123 @@
 #bot.py
 import os
+import io
 import asyncio
-import threading
 import uvicorn
+import uvloop
 import aiohttp
+import orjson
 import tempfile
-import boto3
+import threading
 import time
-import requests
-from urllib.parse import urlparse
-from botocore.config import Config
+import hmac
+import logging
+from enum import IntEnum
+from functools import lru_cache
+from weakref import WeakValueDictionary
 
-from telegram.ext import ApplicationBuilder
-from fastapi import FastAPI, Request
+from telegram.ext import ApplicationBuilder, AIORateLimiter, BaseUpdateProcessor
+from telegram.error import BadRequest
+from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import select, bindparam
+from cachetools import LRUCache, TTLCache
 
 from handlers import conversation_handler
-from db_manager import SessionLocal, Beat, Bundle, BundleBeat, release_beat_reservation, cleanup_expired_reservations
+from callbacks import invalidate_catalog_cache
+from utils import sign_r2_url
+from db_manager import (
+    engine, SessionLocal, Beat, Bundle, BundleBeat, release_beat_reservations, cleanup_expired_reservations,
+    ensure_beat_indexes,
+)
 from config import get_telegram_config, get_r2_config, get_internal_config, print_config_summary
 
+logger = logging.getLogger(__name__)
+
 # Configurazione dinamica basata su ambiente
 TELEGRAM_CONFIG = get_telegram_config()
 R2_CONFIG = get_r2_config()
 INTERNAL_CONFIG = get_internal_config()
 
-TOKEN = TELEGRAM_CONFIG["token"]
-INTERNAL_TOKEN = INTERNAL_CONFIG["token"]
+TOKEN = TELEGRAM_CONFIG.token
+INTERNAL_BOT_URL = INTERNAL_CONFIG.bot_url
+INTERNAL_TOKEN = INTERNAL_CONFIG.token
+INTERNAL_TOKEN_BYTES = (INTERNAL_TOKEN or "").encode("utf-8")  # per il confronto a tempo costante
+
+# Variabili R2 (lette una sola volta all'avvio)
+R2_ACCESS_KEY_ID = R2_CONFIG.access_key_id
+R2_SECRET_ACCESS_KEY = R2_CONFIG.secret_access_key
+R2_ENDPOINT_URL = R2_CONFIG.endpoint_url
+R2_BUCKET_NAME = R2_CONFIG.bucket_name
+R2_PUBLIC_BASE_URL = R2_CONFIG.public_base_url
+
+# Configurazioni R2 mancanti (verificate una volta, segnalate a ogni richiesta di URL firmato)
+R2_MISSING_CONFIGS = [
+    name for name, value in (
+        ("access_key_id", R2_ACCESS_KEY_ID),
+        ("secret_access_key", R2_SECRET_ACCESS_KEY),
+        ("endpoint_url", R2_ENDPOINT_URL),
+        ("bucket_name", R2_BUCKET_NAME),
+        ("public_base_url", R2_PUBLIC_BASE_URL),
+    )
+    if not value
+]
 
-app_fastapi = FastAPI()
+# Dimensione dei blocchi per lo streaming dei file da R2
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Quantità di dati accumulata prima di ogni scrittura su disco (eseguita in un thread)
+DISK_WRITE_BATCH_SIZE = 1024 * 1024
+# Sotto questa dimensione (Content-Length) il file scaricato resta in memoria
+IN_MEMORY_DOWNLOAD_LIMIT = 50 * 1024 * 1024
+# Oltre questa dimensione il buffer temporaneo dei download di dimensione ignota passa su disco
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# orjson per serializzare le risposte: più veloce del json standard
+app_fastapi = FastAPI(default_response_class=ORJSONResponse)
 
 # Stampa configurazione al startup
 print_config_summary()
 
+# Sessione HTTP condivisa per i download da R2 (riusa connessioni TLS e DNS)
+HTTP_CONNECTION_LIMIT = 100
+HTTP_DNS_CACHE_TTL = 300  # secondi
+HTTP_KEEPALIVE_TIMEOUT = 60  # secondi: le connessioni a R2 restano aperte tra un beat e l'altro
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=60)  # 60s per download
+_HTTP_SESSION: aiohttp.ClientSession | None = None
+
+def _get_http_session() -> aiohttp.ClientSession:
+    """Restituisce la sessione HTTP condivisa, creandola se necessario."""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None or _HTTP_SESSION.closed:
+        _HTTP_SESSION = aiohttp.ClientSession(
+            timeout=DOWNLOAD_TIMEOUT,
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_CONNECTION_LIMIT,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ),
+        )
+    return _HTTP_SESSION
+
+@app_fastapi.on_event("startup")
+async def open_http_session():
+    _get_http_session()
+
+@app_fastapi.on_event("shutdown")
+async def close_http_session():
+    global _HTTP_SESSION
+    if _HTTP_SESSION is not None:
+        await _HTTP_SESSION.close()
+        _HTTP_SESSION = None
+
 # Health check endpoint per Railway
 @app_fastapi.get("/health")
 async def health_check():
     return {"status": "healthy", "service": "pegasus-bot"}
 
+# Cache degli URL firmati per file_key: (url, istante oltre il quale va rigenerato)
+SIGNED_URL_CACHE_SIZE = 1024
+_signed_url_cache = {}
+
 def generate_r2_signed_url(key: str, expires_in: int = 3600) -> str:
     """
     Genera un URL firmato per accedere a un file in R2.
@@ -51,143 +133,113 @@ def generate_r2_signed_url(key: str, expires_in: int = 3600) -> str:
         ValueError: Se la configurazione R2 è incompleta
         Exception: Altri errori durante la generazione
     """
-    # Configurazioni R2 dinamiche
-    R2_ACCESS_KEY_ID = R2_CONFIG["access_key_id"]
-    R2_SECRET_ACCESS_KEY = R2_CONFIG["secret_access_key"]
-    R2_ENDPOINT_URL = R2_CONFIG["endpoint_url"]
-    R2_BUCKET_NAME = R2_CONFIG["bucket_name"]
-    R2_PUBLIC_BASE_URL = R2_CONFIG["public_base_url"]
-    
     # Verifica configurazione R2
-    missing_configs = []
-    if not R2_ACCESS_KEY_ID:
-        missing_configs.append("access_key_id")
-    if not R2_SECRET_ACCESS_KEY:
-        missing_configs.append("secret_access_key")
-    if not R2_ENDPOINT_URL:
-        missing_configs.append("endpoint_url")
-    if not R2_BUCKET_NAME:
-        missing_configs.append("bucket_name")
-    if not R2_PUBLIC_BASE_URL:
-        missing_configs.append("public_base_url")
-        
-    if missing_configs:
-        raise ValueError(f"Configurazione R2 incompleta. Mancano: {', '.join(missing_configs)}")
+    if R2_MISSING_CONFIGS:
+        raise ValueError(f"Configurazione R2 incompleta. Mancano: {', '.join(R2_MISSING_CONFIGS)}")
     
     if not key:
         raise ValueError("File key non può essere vuoto o None")
     
+    # Riusa l'URL finché resta valido per almeno metà della sua durata
+    current_time = time.time()
+    cache_key = (key, expires_in)
+    cached = _signed_url_cache.get(cache_key)
+    if cached and current_time < cached[1]:
+        return cached[0]
+
     try:
-        session = boto3.session.Session()
-        s3 = session.client(
-            service_name="s3",
-            aws_access_key_id=R2_ACCESS_KEY_ID,
-            aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-            endpoint_url=R2_ENDPOINT_URL,
-            config=Config(signature_version="s3v4"),
-            region_name="auto"
-        )
-        url = s3.generate_presigned_url(
-            ClientMethod='get_object',
-            Params={'Bucket': R2_BUCKET_NAME, 'Key': key},
-            ExpiresIn=expires_in
-        )
-        parsed = urlparse(url)
-        path_parts = parsed.path.split('/', 2)
-        if len(path_parts) == 3:
-            key_path = path_parts[2]
-        else:
-            key_path = parsed.path.lstrip('/')
-        signed_url = f"{R2_PUBLIC_BASE_URL}/{key_path}?{parsed.query}"
-        return signed_url
+        url = sign_r2_url(key, expires_in)
     except Exception as e:
         raise Exception(f"Errore generazione URL firmato R2 per '{key}': {e}")
 
+    if len(_signed_url_cache) >= SIGNED_URL_CACHE_SIZE:
+        # Rimuove la voce più vecchia (i dict mantengono l'ordine di inserimento)
+        _signed_url_cache.pop(next(iter(_signed_url_cache)))
+    _signed_url_cache[cache_key] = (url, current_time + expires_in / 2)
+    return url
+
+class OrderState(IntEnum):
+    """Stato di un ordine: attesa notificata, consegna in corso, consegnato."""
+    WAITING = 1
+    PROCESSING = 2
+    DELIVERED = 3
+
+# Validità di ciascuno stato in secondi (la TTLCache usa la più lunga)
+ORDER_STATE_TTL = {
+    OrderState.WAITING: 600,      # 10 minuti
+    OrderState.PROCESSING: 300,   # 5 minuti
+    OrderState.DELIVERED: 1800,   # 30 minuti
+}
+
+# Stato degli ordini in memoria: (user_id, beat_title, bundle_id) -> (OrderState, istante di ingresso).
+# TTLCache scade le voci da sola: niente ricostruzione dei dict a ogni richiesta.
+# Gli accessi avvengono tutti sull'event loop senza await intermedi, quindi non servono lock.
+ORDER_CACHE_MAXSIZE = 20000
+_order_states = TTLCache(maxsize=ORDER_CACHE_MAXSIZE, ttl=max(ORDER_STATE_TTL.values()))
+_processed_transactions_cache = TTLCache(maxsize=ORDER_CACHE_MAXSIZE, ttl=1800)  # 30 minuti
+
+def _get_order_state(order_key, current_time):
+    """Restituisce (stato, secondi trascorsi) se lo stato è ancora valido, altrimenti (None, 0)."""
+    entry = _order_states.get(order_key)
+    if entry is None:
+        return None, 0
+    state, since = entry
+    elapsed = current_time - since
+    if elapsed >= ORDER_STATE_TTL[state]:
+        return None, 0
+    return state, elapsed
+
+# Il token è richiesto solo se è configurato l'URL interno del bot
+_AUTH_REQUIRED = bool(INTERNAL_BOT_URL and INTERNAL_TOKEN)
+
+def _unauthorized_response():
+    return ORJSONResponse({"status": "error", "message": "Unauthorized"}, status_code=401)
+
+def _is_authorized(request: Request) -> bool:
+    """Verifica l'header X-Internal-Token con un confronto a tempo costante."""
+    if not _AUTH_REQUIRED:
+        return True
+    internal_token = request.headers.get("X-Internal-Token") or ""
+    return hmac.compare_digest(internal_token.encode("utf-8"), INTERNAL_TOKEN_BYTES)
+
 @app_fastapi.post("/internal/send_waiting_message")
 async def send_waiting_message_endpoint(request: Request):
-    # Sicurezza: verifica internal token usando configurazione dinamica
-    internal_config = get_internal_config()
-    internal_token = request.headers.get("X-Internal-Token")
-    if internal_config["bot_url"]:
-        if internal_config["token"] and (internal_token != internal_config["token"]):
-            return {"status": "error", "message": "Unauthorized"}, 401
-
-    data = await request.json()
+    # Sicurezza: verifica internal token
+    if not _is_authorized(request):
+        return _unauthorized_response()
+
+    data = orjson.loads(await request.body())
     user_id = data.get("user_id")
     beat_title = data.get("beat_title")
     bundle_id = data.get("bundle_id")
     order_type = data.get("order_type", "beat")
     
-    # CACHE PER MESSAGGI DI ATTESA: Evita duplicati basandosi su user_id + beat_title
-    import time
-    cache_key = f"waiting_msg_{user_id}_{beat_title}_{bundle_id or 'none'}"
-    processing_key = f"processing_{user_id}_{beat_title}_{bundle_id or 'none'}"
-    
-    if not hasattr(app_fastapi, '_waiting_messages_cache'):
-        app_fastapi._waiting_messages_cache = {}
-    if not hasattr(app_fastapi, '_currently_processing'):
-        app_fastapi._currently_processing = {}
-    
+    # STATO ORDINE: Evita duplicati basandosi su user_id + beat_title + bundle_id
+    order_key = (user_id, beat_title, bundle_id)
     current_time = time.time()
+    state, elapsed = _get_order_state(order_key, current_time)
     
-    # Pulisci cache entries vecchi (>10 minuti)
-    app_fastapi._waiting_messages_cache = {
-        k: v for k, v in app_fastapi._waiting_messages_cache.items()
-        if current_time - v < 600  # 10 minuti
-    }
-    
-    # Controlla se stiamo già processando questo ordine (arrivo tardivo del messaggio di attesa)
-    if processing_key in app_fastapi._currently_processing:
-        elapsed = current_time - app_fastapi._currently_processing[processing_key]
-        if elapsed < 300:  # Se stiamo processando da meno di 5 minuti
-            print(f"[INFO] Ordine {beat_title} già in elaborazione da {elapsed:.1f}s - skip messaggio attesa tardivo")
-            return {"status": "ok", "message": "Order already being processed - late waiting message ignored"}
-    
-    # **NUOVO: Controlla se l'ordine è già stato consegnato**
-    delivery_cache_key = f"delivered_{user_id}_{beat_title}"
-    if not hasattr(app_fastapi, '_delivered_orders_cache'):
-        app_fastapi._delivered_orders_cache = {}
-    
-    # Pulisci cache consegne vecchie (>30 minuti)
-    app_fastapi._delivered_orders_cache = {
-        k: v for k, v in app_fastapi._delivered_orders_cache.items()
-        if current_time - v < 1800
-    }
-    
-    if delivery_cache_key in app_fastapi._delivered_orders_cache:
-        elapsed = current_time - app_fastapi._delivered_orders_cache[delivery_cache_key]
-        print(f"[INFO] Beat {beat_title} già consegnato {elapsed:.1f}s fa - skip messaggio attesa tardivo")
+    if state is OrderState.PROCESSING:
+        # Arrivo tardivo del messaggio di attesa: l'ordine è già in elaborazione
+        logger.info("Ordine %s già in elaborazione da %.1fs - skip messaggio attesa tardivo", beat_title, elapsed)
+        return {"status": "ok", "message": "Order already being processed - late waiting message ignored"}
+    if state is OrderState.DELIVERED:
+        logger.info("Beat %s già consegnato %.1fs fa - skip messaggio attesa tardivo", beat_title, elapsed)
         return {"status": "ok", "message": "Beat already delivered - waiting message skipped"}
-    
-    # Controlla se già inviato
-    if cache_key in app_fastapi._waiting_messages_cache:
-        print(f"[INFO] Messaggio di attesa già inviato per {beat_title} a user {user_id} - skip")
+    if state is OrderState.WAITING:
+        logger.info("Messaggio di attesa già inviato per %s a user %s - skip", beat_title, user_id)
         return {"status": "ok", "message": "Waiting message already sent"}
     
     # Segna come inviato
-    app_fastapi._waiting_messages_cache[cache_key] = current_time
+    _order_states[order_key] = (OrderState.WAITING, current_time)
     
     # Determina se è un beat singolo o un bundle
     is_bundle = order_type == "bundle" and bundle_id is not None
 
     # Invia messaggio di attesa (più breve e immediato)
     try:
-        if is_bundle:
-            message = (
-                "⏳ <b>Ordine confermato!</b>\n"
-                f"📦 Bundle: <b>{beat_title}</b>\n\n"
-                "💳 Pagamento verificato con successo!\n"
-                "🎵 Preparazione dei file in corso...\n\n"
-                "📞 <i>Per assistenza utilizza il pulsante \"Contattaci\" o scrivici su Instagram</i>"
-            )
-        else:
-            message = (
-                "⏳ <b>Ordine confermato!</b>\n"
-                f"🎵 Beat: <b>{beat_title}</b>\n\n"
-                "💳 Pagamento verificato con successo!\n"
-                "📁 Preparazione del file in corso...\n\n"
-                "📞 <i>Per assistenza utilizza il pulsante \"Contattaci\" o scrivici su Instagram</i>"
-            )
+        template = WAITING_MESSAGE_BUNDLE if is_bundle else WAITING_MESSAGE_SINGLE
+        message = template.format(beat_title=beat_title)
         
         await app_fastapi.bot.send_message(
             chat_id=user_id,
@@ -195,299 +247,428 @@ async def send_waiting_message_endpoint(request: Request):
             parse_mode="HTML"
         )
         
-        print(f"[INFO] Messaggio attesa inviato a user {user_id}")
+        logger.info("Messaggio attesa inviato a user %s", user_id)
         return {"status": "ok", "message": "Waiting message sent"}
         
     except Exception as e:
-        print(f"[ERROR] Errore invio messaggio attesa: {e}")
+        logger.error("Errore invio messaggio attesa: %s", e)
         return {"status": "error", "message": str(e)}
 
 @app_fastapi.post("/internal/send_message")
-async def send_message_endpoint(request: Request):
+async def send_message_endpoint(request: Request, background_tasks: BackgroundTasks):
+    # Sicurezza: verifica internal token
+    if not _is_authorized(request):
+        return _unauthorized_response()
+
     try:
-        # Sicurezza: verifica internal token usando configurazione dinamica
-        internal_config = get_internal_config()
-        internal_token = request.headers.get("X-Internal-Token")
-        if internal_config["bot_url"]:
-            if internal_config["token"] and (internal_token != internal_config["token"]):
-                return {"status": "error", "message": "Unauthorized"}, 401
-
-        data = await request.json()
+        data = orjson.loads(await request.body())
         user_id = data.get("user_id")
         beat_title = data.get("beat_title")
         bundle_id = data.get("bundle_id")
         order_type = data.get("order_type", "beat")
         transaction_id = data.get("transaction_id")
         
+        # Un messaggio di attesa recente rende superfluo quello di elaborazione
+        order_key = (user_id, beat_title, bundle_id)
+        current_time = time.time()
+        state, elapsed = _get_order_state(order_key, current_time)
+        waiting_sent = state is OrderState.WAITING
+        if waiting_sent:
+            logger.info("Messaggio di attesa già inviato %.1fs fa - skip secondo messaggio", elapsed)
+        
         # IDEMPOTENZA: Controlla se abbiamo già processato questa transazione
         if transaction_id:
             # Usa una cache in memoria per transazioni recenti (ultimi 30 minuti)
-            import time
             cache_key = f"processed_txn_{transaction_id}"
             
-            # Cache semplice in memoria (potrebbe essere migliorata con Redis in produzione)
-            if not hasattr(app_fastapi, '_processed_transactions_cache'):
-                app_fastapi._processed_transactions_cache = {}
-            
-            current_time = time.time()
-            
-            # Pulisci cache entries vecchi (>30 minuti)
-            app_fastapi._processed_transactions_cache = {
-                k: v for k, v in app_fastapi._processed_transactions_cache.items()
-                if current_time - v < 1800  # 30 minuti
-            }
-            
             # Controlla se già processato
-            if cache_key in app_fastapi._processed_transactions_cache:
-                print(f"[WARNING] Transazione {transaction_id} già processata - rifiuto duplicato")
+            if cache_key in _processed_transactions_cache:
+                logger.warning("Transazione %s già processata - rifiuto duplicato", transaction_id)
                 return {"status": "ok", "message": "Transaction already processed (idempotent)"}
             
             # MARCA CHE STIAMO PROCESSANDO per evitare messaggi di attesa in ritardo
-            processing_key = f"processing_{user_id}_{beat_title}_{bundle_id or 'none'}"
-            if not hasattr(app_fastapi, '_currently_processing'):
-                app_fastapi._currently_processing = {}
-            app_fastapi._currently_processing[processing_key] = current_time
+            _order_states[order_key] = (OrderState.PROCESSING, current_time)
             
             # Segna come processato
-            app_fastapi._processed_transactions_cache[cache_key] = current_time
-            print(f"[INFO] Elaborazione transazione {transaction_id} - prima volta")
-        
-        # Chiama la funzione principale e restituisce il risultato
-        return await send_beat_to_user(user_id, beat_title, bundle_id, order_type, transaction_id)
+            _processed_transactions_cache[cache_key] = current_time
+            logger.info("Elaborazione transazione %s - prima volta", transaction_id)
+    except Exception as e:
+        logger.error("Richiesta send_message non valida: %s", e)
+        return {"status": "error", "message": f"Invalid request: {str(e)}"}
+
+    # La consegna avviene dopo la risposta: il chiamante non attende l'upload su Telegram
+    background_tasks.add_task(_deliver_beat, user_id, beat_title, bundle_id, order_type, transaction_id, waiting_sent)
+    return {"status": "accepted", "message": "Delivery scheduled"}
+
+async def _deliver_beat(user_id, beat_title, bundle_id, order_type, transaction_id, waiting_sent):
+    """
+    Esegue la consegna in background dopo la risposta HTTP.
+    Gli errori non possono più raggiungere il chiamante: vengono loggati e notificati all'utente.
+    """
+    try:
+        result = await send_beat_to_user(user_id, beat_title, bundle_id, order_type, transaction_id, waiting_sent)
+        logger.info("Consegna completata per user %s: %s", user_id, result)
         
     except Exception as critical_error:
-        # Gestione errori critici - assicuriamoci di restituire sempre un errore chiaro
-        print(f"[CRITICAL ERROR] Errore critico in send_message_endpoint: {critical_error}")
-        import traceback
-        traceback.print_exc()
+        # Gestione errori critici
+        logger.critical("Errore critico nella consegna: %s", critical_error, exc_info=True)
         
         # Tentativo di notificare l'utente dell'errore se possibile
         try:
-            if 'user_id' in locals():
-                await app_fastapi.bot.send_message(
-                    chat_id=user_id,
-                    text=(
-                        "❌ Si è verificato un errore durante l'elaborazione del tuo ordine.\n"
-                        "Il nostro team è stato notificato e risolverà il problema al più presto.\n\n"
-                        "📞 Instagram: https://linktr.ee/ProdByPegasus"
-                    )
-                )
+            await app_fastapi.bot.send_message(
+                chat_id=user_id,
+                text=CRITICAL_ERROR_MESSAGE
+            )
         except:
             pass  # Se non riusciamo a inviare il messaggio, ignora
-            
-        return {"status": "error", "message": f"Critical error: {str(critical_error)}"}
 
-async def send_beat_to_user(user_id, beat_title, bundle_id=None, order_type="beat", transaction_id=None):
+# Cache dei beat per titolo: il catalogo cambia raramente, evita una query per ogni consegna
+BEAT_LOOKUP_TTL = 60  # secondi
+# Letta e scritta dai thread di _load_order_beats: TTLCache non è thread-safe, serve un lock
+_beat_lookup_cache = TTLCache(maxsize=1024, ttl=BEAT_LOOKUP_TTL)
+_beat_lookup_lock = threading.Lock()
+_BEAT_LOOKUP_STMT = select(Beat.id, Beat.title, Beat.file_key, Beat.is_exclusive).where(
+    Beat.title == bindparam("title")
+).limit(1)
+
+def _load_beat_row(beat_title):
+    """Restituisce i dati di consegna del beat (id, title, file_key, is_exclusive) o None se non esiste."""
+    with _beat_lookup_lock:
+        cached = _beat_lookup_cache.get(beat_title)
+    if cached is not None:
+        return cached
+
+    # SELECT Core delle sole colonne necessarie: nessuna istanza ORM da idratare
+    with engine.connect() as conn:
+        row = conn.execute(_BEAT_LOOKUP_STMT, {"title": beat_title}).first()
+    if row is None:
+        return None  # Non mettere in cache i beat mancanti: potrebbero essere aggiunti a breve
+
+    with _beat_lookup_lock:
+        _beat_lookup_cache[beat_title] = row
+    return row
+
+@lru_cache(maxsize=4096)
+def _normalize_file_key(raw_key: str) -> str:
+    """Porta la chiave del file nel prefisso private/beats/ se non è già sotto private/."""
+    if raw_key.startswith("private/"):
+        return raw_key
+    return f"private/beats/{raw_key.lstrip('/')}"
+
+# Numero massimo di beat di un bundle inviati contemporaneamente
+BUNDLE_DELIVERY_CONCURRENCY = 4
+
+# Template dei messaggi di consegna (solo i campi variabili vengono formattati a ogni invio)
+PAYMENT_RECEIVED_BUNDLE = (
+    "✅ Pagamento ricevuto!\n"
+    "🆔 ID transazione: <code>{tid}</code>\n"
+    "📦 Bundle: <b>{bundle_title}</b>\n"
+    "Sto preparando tutti i beat del bundle in formato WAV, riceverai i file tra qualche secondo/minuto.\n\n"
+    "Per assistenza scrivici su Instagram tramite il pulsante \"Contattaci\"."
+)
+PAYMENT_RECEIVED_SINGLE = (
+    "✅ Pagamento ricevuto!\n"
+    "🆔 ID transazione: <code>{tid}</code>\n"
+    "Sto preparando il tuo beat in formato WAV, riceverai il file tra qualche secondo/minuto.\n\n"
+    "Per assistenza scrivici su Instagram tramite il pulsante \"Contattaci\"."
+)
+WAITING_MESSAGE_BUNDLE = (
+    "⏳ <b>Ordine confermato!</b>\n"
+    "📦 Bundle: <b>{beat_title}</b>\n\n"
+    "💳 Pagamento verificato con successo!\n"
+    "🎵 Preparazione dei file in corso...\n\n"
+    "📞 <i>Per assistenza utilizza il pulsante \"Contattaci\" o scrivici su Instagram</i>"
+)
+WAITING_MESSAGE_SINGLE = (
+    "⏳ <b>Ordine confermato!</b>\n"
+    "🎵 Beat: <b>{beat_title}</b>\n\n"
+    "💳 Pagamento verificato con successo!\n"
+    "📁 Preparazione del file in corso...\n\n"
+    "📞 <i>Per assistenza utilizza il pulsante \"Contattaci\" o scrivici su Instagram</i>"
+)
+DELIVERY_SUMMARY_MESSAGE = (
+    "📊 <b>Resoconto invio:</b>\n"
+    "✅ Inviati: {sent}/{total}\n"
+    "❌ Falliti: {failed}\n\n"
+    "<b>Beat non inviati:</b>\n{failed_list}\n\n"
+    "🔄 Riprova a contattare l'assistenza se alcuni beat non sono arrivati.\n"
+    "📞 Instagram: https://linktr.ee/ProdByPegasus\n\n"
+    "🔄 <b>Per tornare al catalogo digita /start</b>"
+)
+BUNDLE_COMPLETED_MESSAGE = (
+    "🎉 <b>Bundle completato!</b>\n"
+    "✅ Tutti i {sent} beat sono stati inviati con successo!\n\n"
+    "📱 Ricorda di salvare i file nei messaggi salvati di Telegram.\n\n"
+    "🔄 <b>Per tornare al catalogo digita /start</b>"
+)
+DELIVERY_ERROR_MESSAGE = (
+    "❌ <b>Errore durante l'invio dei beat</b>\n\n"
+    "✅ Beat inviati: {sent}/{total}\n"
+    "❌ Errore: {error}\n\n"
+    "🔄 Contatta l'assistenza per ricevere i beat mancanti.\n"
+    "📞 Instagram: https://linktr.ee/ProdByPegasus\n\n"
+    "🔄 <b>Per tornare al catalogo digita /start</b>"
+)
+CRITICAL_ERROR_MESSAGE = (
+    "❌ Si è verificato un errore durante l'elaborazione del tuo ordine.\n"
+    "Il nostro team è stato notificato e risolverà il problema al più presto.\n\n"
+    "📞 Instagram: https://linktr.ee/ProdByPegasus"
+)
+CAPTION_HEAD_BUNDLE = (
+    "📦 Bundle: <b>{bundle_title}</b>\n"
+    "🎵 Beat {idx}/{total}: <b>{beat_title}</b>\n"
+    "🆔 ID transazione: <code>{tid}</code>\n\n"
+    "✅ Pagamento verificato.\n\n"
+)
+CAPTION_HEAD_SINGLE = (
+    "Ecco il tuo beat <b>{beat_title}</b> in formato WAV!\n"
+    "🆔 ID transazione: <code>{tid}</code>\n\n"
+    "✅ Pagamento verificato.\n\n"
+)
+CAPTION_EXCLUSIVE = (
+    "<b>🔒 Questo beat è esclusivo e sarà disponibile solo per te!</b>\n"
+    "<i>Sei l'unico che potrà utilizzarlo liberamente per il tuo progetto.</i>\n\n"
+)
+CAPTION_TAIL_BUNDLE = (
+    "📦 <b>Questo completa il tuo bundle!</b>\n"
+    "Consigliamo di salvare tutti i beat nei messaggi salvati di Telegram\n"
+    "oppure scaricarli sul tuo dispositivo.\n"
+    "Se dovessi perdere i file, <u>non assumiamo responsabilità.</u>"
+)
+CAPTION_TAIL_SINGLE = (
+    "Consigliamo di salvare il beat nei messaggi salvati di Telegram\n"
+    "oppure scaricarlo sul tuo dispositivo.\n"
+    "Se dovessi perdere il file, <u>non assumiamo responsabilità.</u>\n\n"
+    "🔄 <b>Per tornare al catalogo digita /start</b>"
+)
+
+# file_id assegnati da Telegram ai beat già inviati: un reinvio non trasferisce più il file.
+# LRU limitata: i beat meno richiesti escono e al bisogno ripassano dall'URL firmato
+_telegram_file_ids = LRUCache(maxsize=4096)
+# Chiavi per cui Telegram ha rifiutato l'URL firmato: si passa subito al download.
+# Con scadenza, così un rifiuto temporaneo non esclude l'URL fino al riavvio
+URL_REJECTED_TTL = 3600  # secondi
+_url_rejected_keys = TTLCache(maxsize=1024, ttl=URL_REJECTED_TTL)
+
+async def _send_beat_document(user_id, document, filename, caption, file_key=None):
+    """Invia il file del beat all'utente con timeout adatti a file WAV di grandi dimensioni."""
+    message = await asyncio.wait_for(
+        app_fastapi.bot.send_document(
+            chat_id=user_id,
+            document=document,
+            filename=filename,
+            caption=caption,
+            parse_mode="HTML",
+            read_timeout=120,  # 2 minuti per upload
+            write_timeout=120,
+            connect_timeout=30
+        ),
+        timeout=180  # 3 minuti totali
+    )
+    if file_key and message.document:
+        _telegram_file_ids[file_key] = message.document.file_id
+    return message
+
+async def _send_beat_via_download(user_id, signed_url, filename, caption, file_key=None):
+    """
+    Fallback: scarica il beat da R2 e lo carica su Telegram tramite il bot.
+    Restituisce None se l'invio è riuscito, altrimenti il messaggio di errore.
+    """
+    # Scarica il file con timeout aumentato, riusando la sessione condivisa
+    async with _get_http_session().get(signed_url) as resp:
+        if resp.status != 200:
+            return f"❌ Errore download: HTTP {resp.status}"
+
+        # File di dimensione nota e contenuta: resta in memoria, nessun accesso al disco
+        if resp.content_length is not None and resp.content_length <= IN_MEMORY_DOWNLOAD_LIMIT:
+            buf = io.BytesIO()
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                buf.write(chunk)
+        else:
+            # Dimensione ignota o elevata: SpooledTemporaryFile resta in memoria fino a
+            # SPOOL_MAX_SIZE e passa su disco solo oltre. Il with lo elimina anche se
+            # download o invio falliscono; lo stesso handle viene riletto dopo seek(0).
+            # Le scritture girano in un thread, raggruppando i blocchi per limitare i dispatch.
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, suffix=".wav") as tmp:
+                pending, pending_size = [], 0
+                async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    pending.append(chunk)
+                    pending_size += len(chunk)
+                    if pending_size >= DISK_WRITE_BATCH_SIZE:
+                        await asyncio.to_thread(tmp.writelines, pending)
+                        pending, pending_size = [], 0
+                if pending:
+                    await asyncio.to_thread(tmp.writelines, pending)
+                tmp.seek(0)
+                # Invia il file con timeout aumentato
+                await _send_beat_document(user_id, tmp, filename, caption, file_key)
+            return None
+
+    # Invia il file con timeout aumentato (connessione a R2 già rilasciata)
+    await _send_beat_document(user_id, buf.getvalue(), filename, caption, file_key)
+    return None
+
+async def _send_beat(user_id, file_key, filename, caption):
+    """
+    Invia il beat scegliendo la via più economica: file_id già noto a Telegram,
+    poi URL firmato (Telegram scarica da R2), infine download tramite il bot.
+    Restituisce None se l'invio è riuscito, altrimenti il messaggio di errore.
+    """
+    file_id = _telegram_file_ids.get(file_key)
+    if file_id:
+        try:
+            await _send_beat_document(user_id, file_id, filename, caption)
+            return None
+        except BadRequest as file_id_error:
+            logger.info("file_id non più valido per '%s' (%s) - invio da R2", filename, file_id_error)
+            _telegram_file_ids.pop(file_key, None)
+
+    signed_url = generate_r2_signed_url(file_key, expires_in=3600)
+    logger.debug("Signed URL generato per '%s': %s", filename, signed_url)
+
+    if file_key not in _url_rejected_keys:
+        # Telegram scarica il file direttamente da R2: nessun byte passa dal bot
+        try:
+            await _send_beat_document(user_id, signed_url, filename, caption, file_key)
+            return None
+        except BadRequest as url_error:
+            # URL rifiutato da Telegram (es. file oltre il limite per l'invio via URL): il file passa dal bot
+            logger.info("Invio via URL non riuscito per '%s' (%s) - fallback con download", filename, url_error)
+            _url_rejected_keys[file_key] = True
+
+    return await _send_beat_via_download(user_id, signed_url, filename, caption, file_key)
+
+def _load_order_beats(is_bundle, bundle_id, beat_title):
+    """
+    Recupera i beat da consegnare (eseguita in un thread).
+    Restituisce (beats, errore) dove errore è None oppure (testo per l'utente, messaggio di stato).
+    """
+    if not is_bundle:
+        # Per beat singoli, recupera il beat specifico
+        beat = _load_beat_row(beat_title)
+        if not beat:
+            return [], (f"❌ Errore: Beat '{beat_title}' non trovato. Contatta l'assistenza.", "Beat not found")
+        return [beat], None  # Lista con un solo beat per uniformità
+
+    with SessionLocal() as db:
+        # Per i bundle, recupera tutti i beat contenuti
+        bundle = db.query(Bundle.id).filter(Bundle.id == bundle_id).first()
+        if not bundle:
+            return [], ("❌ Errore: Bundle non trovato. Contatta l'assistenza.", "Bundle not found")
+        # Recupera in una query le sole colonne necessarie alla consegna:
+        # tuple semplici, utilizzabili anche dopo la chiusura della sessione
+        beats = db.query(Beat.id, Beat.title, Beat.file_key, Beat.is_exclusive).join(BundleBeat).filter(
+            BundleBeat.bundle_id == bundle_id
+        ).all()
+    if not beats:
+        return [], ("❌ Errore: Nessun beat trovato nel bundle. Contatta l'assistenza.", "No beats found in bundle")
+    return beats, None
+
+async def send_beat_to_user(user_id, beat_title, bundle_id=None, order_type="beat", transaction_id=None, waiting_sent=False):
     """
     Funzione principale per inviare beat/bundle all'utente.
     Restituisce sempre uno status corretto.
     """
-    import time
-    
     # Determina se è un beat singolo o un bundle
     is_bundle = order_type == "bundle" and bundle_id is not None
 
-    # **NUOVO: Controlla se abbiamo già inviato un messaggio di attesa**
-    waiting_cache_key = f"waiting_msg_{user_id}_{beat_title}_{bundle_id or 'none'}"
-    has_waiting_message = False
-    
-    if hasattr(app_fastapi, '_waiting_messages_cache'):
-        current_time = time.time()
-        if waiting_cache_key in app_fastapi._waiting_messages_cache:
-            elapsed = current_time - app_fastapi._waiting_messages_cache[waiting_cache_key]
-            if elapsed < 600:  # Se il messaggio di attesa è stato inviato negli ultimi 10 minuti
-                has_waiting_message = True
-                print(f"[INFO] Messaggio di attesa già inviato {elapsed:.1f}s fa - skip secondo messaggio")
-
-    # Invia messaggio di elaborazione SOLO se non c'è già un messaggio di attesa
-    if not has_waiting_message:
+    # Invia messaggio di elaborazione SOLO se non c'è già un messaggio di attesa.
+    # L'invio parte in background e si sovrappone alla lettura dal DB.
+    notify_task = None
+    if not waiting_sent:
         if is_bundle:
-            await app_fastapi.bot.send_message(
-                chat_id=user_id,
-                text=(
-                    "✅ Pagamento ricevuto!\n"
-                    f"🆔 ID transazione: <code>{transaction_id}</code>\n"
-                    f"📦 Bundle: <b>{beat_title}</b>\n"
-                    "Sto preparando tutti i beat del bundle in formato WAV, riceverai i file tra qualche secondo/minuto.\n\n"
-                    "Per assistenza scrivici su Instagram tramite il pulsante \"Contattaci\"."
-                ),
-                parse_mode="HTML"
-            )
+            notice = PAYMENT_RECEIVED_BUNDLE.format(tid=transaction_id, bundle_title=beat_title)
         else:
-            await app_fastapi.bot.send_message(
-                chat_id=user_id,
-                text=(
-                    "✅ Pagamento ricevuto!\n"
-                    f"🆔 ID transazione: <code>{transaction_id}</code>\n"
-                    "Sto preparando il tuo beat in formato WAV, riceverai il file tra qualche secondo/minuto.\n\n"
-                    "Per assistenza scrivici su Instagram tramite il pulsante \"Contattaci\"."
-                ),
-                parse_mode="HTML"
-            )
+            notice = PAYMENT_RECEIVED_SINGLE.format(tid=transaction_id)
+        notify_task = asyncio.create_task(
+            app_fastapi.bot.send_message(chat_id=user_id, text=notice, parse_mode="HTML")
+        )
     else:
-        print(f"[INFO] Skip messaggio elaborazione - utente {user_id} ha già ricevuto messaggio di attesa")
+        logger.info("Skip messaggio elaborazione - utente %s ha già ricevuto messaggio di attesa", user_id)
 
-    # Recupera i beat dal DB
-    with SessionLocal() as db:
-        if is_bundle:
-            # Per i bundle, recupera tutti i beat contenuti
-            bundle = db.query(Bundle).filter(Bundle.id == bundle_id).first()
-            if not bundle:
-                await app_fastapi.bot.send_message(
-                    chat_id=user_id,
-                    text=f"❌ Errore: Bundle non trovato. Contatta l'assistenza."
-                )
-                return {"status": "error", "message": "Bundle not found"}
-            
-            # Recupera tutti i beat del bundle
-            beats = db.query(Beat).join(BundleBeat).filter(
-                BundleBeat.bundle_id == bundle_id
-            ).all()
-            
-            if not beats:
-                await app_fastapi.bot.send_message(
-                    chat_id=user_id,
-                    text=f"❌ Errore: Nessun beat trovato nel bundle. Contatta l'assistenza."
-                )
-                return {"status": "error", "message": "No beats found in bundle"}
-        else:
-            # Per beat singoli, recupera il beat specifico
-            beat = db.query(Beat).filter(Beat.title == beat_title).first()
-            if not beat:
-                await app_fastapi.bot.send_message(
-                    chat_id=user_id,
-                    text=f"❌ Errore: Beat '{beat_title}' non trovato. Contatta l'assistenza."
-                )
-                return {"status": "error", "message": "Beat not found"}
-            beats = [beat]  # Lista con un solo beat per uniformità
+    # Recupera i beat dal DB in un thread: le query sincrone non bloccano l'event loop
+    beats, lookup_error = await asyncio.to_thread(_load_order_beats, is_bundle, bundle_id, beat_title)
+
+    # Il messaggio di elaborazione deve arrivare prima di qualsiasi altro invio
+    if notify_task is not None:
+        await notify_task
+
+    if lookup_error:
+        error_text, status_message = lookup_error
+        await app_fastapi.bot.send_message(chat_id=user_id, text=error_text)
+        return {"status": "error", "message": status_message}
 
     # Scarica e invia i beat con gestione timeout migliorata
     failed_beats = []
     success_count = 0
     
     try:
-        for idx, beat in enumerate(beats):
-            try:
-                file_key = beat.file_key
-                if not file_key:
-                    error_msg = "❌ Errore: file_key mancante nel database"
-                    print(f"[ERROR] {error_msg} per beat '{beat.title}'")
-                    failed_beats.append((beat.title, error_msg))
-                    continue
+        semaphore = asyncio.Semaphore(BUNDLE_DELIVERY_CONCURRENCY)
+        to_release = []  # id dei beat esclusivi consegnati
+
+        async def _deliver_one(idx, beat):
+            """Consegna un singolo beat. Restituisce None se riuscito, altrimenti il messaggio di errore."""
+            async with semaphore:
+                try:
+                    file_key = beat.file_key
+                    if not file_key:
+                        return "❌ Errore: file_key mancante nel database"
+                        
+                    file_key = _normalize_file_key(file_key)
+                    is_exclusive = getattr(beat, "is_exclusive", 0) == 1
+
+                    logger.info("Elaborazione beat %s/%s: %s", idx + 1, len(beats), beat.title)
                     
-                if not file_key.startswith("private/"):
-                    file_key = f"private/beats/{file_key.lstrip('/')}"
-                is_exclusive = getattr(beat, "is_exclusive", 0) == 1
+                    if is_bundle:
+                        head = CAPTION_HEAD_BUNDLE.format(
+                            bundle_title=beat_title, idx=idx + 1, total=len(beats),
+                            beat_title=beat.title, tid=transaction_id or 'N/A'
+                        )
+                        tail = CAPTION_TAIL_BUNDLE if idx == len(beats) - 1 else ""
+                    else:
+                        head = CAPTION_HEAD_SINGLE.format(beat_title=beat.title, tid=transaction_id or 'N/A')
+                        tail = CAPTION_TAIL_SINGLE
+                    caption = "".join((head, CAPTION_EXCLUSIVE if is_exclusive else "", tail))
 
-                print(f"[INFO] Elaborazione beat {idx + 1}/{len(beats)}: {beat.title}")
-                
-                # Timeout più lungo per il download
-                signed_url = generate_r2_signed_url(file_key, expires_in=3600)
-                print(f"[DEBUG] Signed URL generato: {signed_url}")
-
-                if is_bundle:
-                    caption = (
-                        f"📦 Bundle: <b>{beat_title}</b>\n"
-                        f"🎵 Beat {idx + 1}/{len(beats)}: <b>{beat.title}</b>\n"
-                        f"🆔 ID transazione: <code>{transaction_id or 'N/A'}</code>\n\n"
-                        "✅ Pagamento verificato.\n\n"
-                    )
-                else:
-                    caption = (
-                        f"Ecco il tuo beat <b>{beat.title}</b> in formato WAV!\n"
-                        f"🆔 ID transazione: <code>{transaction_id or 'N/A'}</code>\n\n"
-                        "✅ Pagamento verificato.\n\n"
-                    )
-                
-                if is_exclusive:
-                    caption += (
-                        "<b>🔒 Questo beat è esclusivo e sarà disponibile solo per te!</b>\n"
-                        "<i>Sei l'unico che potrà utilizzarlo liberamente per il tuo progetto.</i>\n\n"
-                    )
-                
-                if is_bundle and idx == len(beats) - 1:
-                    # Ultimo beat del bundle
-                    caption += (
-                        "📦 <b>Questo completa il tuo bundle!</b>\n"
-                        "Consigliamo di salvare tutti i beat nei messaggi salvati di Telegram\n"
-                        "oppure scaricarli sul tuo dispositivo.\n"
-                        "Se dovessi perdere i file, <u>non assumiamo responsabilità.</u>"
-                    )
-                elif not is_bundle:
-                    caption += (
-                        "Consigliamo di salvare il beat nei messaggi salvati di Telegram\n"
-                        "oppure scaricarlo sul tuo dispositivo.\n"
-                        "Se dovessi perdere il file, <u>non assumiamo responsabilità.</u>\n\n"
-                        "🔄 <b>Per tornare al catalogo digita /start</b>"
-                    )
-
-                # Scarica il file con timeout aumentato
-                download_timeout = aiohttp.ClientTimeout(total=60)  # 60s per download
-                async with aiohttp.ClientSession(timeout=download_timeout) as session:
-                    async with session.get(signed_url) as resp:
-                        if resp.status != 200:
-                            error_msg = f"❌ Errore download: HTTP {resp.status}"
-                            print(f"[ERROR] {error_msg} per beat '{beat.title}'")
-                            failed_beats.append((beat.title, error_msg))
-                            continue
-                            
-                        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-                            tmp.write(await resp.read())
-                            tmp_path = tmp.name
+                    logger.info("Invio beat '%s' a user %s", beat.title, user_id)
+                    error_msg = await _send_beat(user_id, file_key, f"{beat.title}.wav", caption)
+                    if error_msg:
+                        return error_msg
 
-                # Invia il file con timeout aumentato
-                print(f"[INFO] Invio beat '{beat.title}' a user {user_id}")
-                with open(tmp_path, "rb") as f:
-                    await asyncio.wait_for(
-                        app_fastapi.bot.send_document(
-                            chat_id=user_id,
-                            document=f,
-                            filename=f"{beat.title}.wav",
-                            caption=caption,
-                            parse_mode="HTML",
-                            read_timeout=120,  # 2 minuti per upload
-                            write_timeout=120,
-                            connect_timeout=30
-                        ),
-                        timeout=180  # 3 minuti totali
-                    )
-                
-                import os
-                os.remove(tmp_path)
-                success_count += 1
-                print(f"[SUCCESS] Beat '{beat.title}' inviato con successo ({success_count}/{len(beats)})")
-                
-                # Rilascia la prenotazione se il beat era esclusivo e prenotato
-                if is_exclusive:
-                    release_beat_reservation(beat.id, user_id)
-                    print(f"[INFO] Prenotazione rilasciata per beat esclusivo '{beat.title}' (user: {user_id})")
-                
-                # Pausa tra beat per evitare rate limiting e sovraccarico
-                if is_bundle and idx < len(beats) - 1:
-                    await asyncio.sleep(2)  # Aumentata a 2 secondi
+                    logger.info("Beat '%s' inviato con successo", beat.title)
                     
-            except asyncio.TimeoutError:
-                error_msg = "❌ Timeout durante invio"
-                print(f"[ERROR] {error_msg} per beat '{beat.title}'")
-                failed_beats.append((beat.title, error_msg))
-                continue
-            except Exception as beat_error:
-                error_msg = f"❌ Errore: {str(beat_error)}"
-                print(f"[ERROR] {error_msg} per beat '{beat.title}'")
+                    # La prenotazione del beat esclusivo viene rilasciata a fine consegna, insieme alle altre
+                    if is_exclusive:
+                        to_release.append(beat.id)
+                    return None
+                        
+                except asyncio.TimeoutError:
+                    return "❌ Timeout durante invio"
+                except Exception as beat_error:
+                    return f"❌ Errore: {str(beat_error)}"
+
+        # Beat inviati in parallelo (con limite); l'ultimo chiude il bundle e parte dopo gli altri
+        results = await asyncio.gather(*(_deliver_one(idx, beat) for idx, beat in enumerate(beats[:-1])))
+        results.append(await _deliver_one(len(beats) - 1, beats[-1]))
+
+        for beat, error_msg in zip(beats, results):
+            if error_msg:
+                logger.error("%s per beat '%s'", error_msg, beat.title)
                 failed_beats.append((beat.title, error_msg))
-                continue
+        success_count = len(beats) - len(failed_beats)
+
+        # Rilascia in un solo UPDATE le prenotazioni dei beat esclusivi consegnati
+        if to_release:
+            released = await asyncio.to_thread(release_beat_reservations, to_release, user_id)
+            logger.info("Prenotazioni rilasciate per %s beat esclusivi (user: %s)", released, user_id)
+            # Beat esclusivi venduti: il catalogo in cache non deve continuare a mostrarli
+            invalidate_catalog_cache()
                 
         # Invia resoconto finale se ci sono stati errori
         if failed_beats:
             failed_list = "\n".join([f"• {title}: {error}" for title, error in failed_beats])
-            summary_msg = (
-                f"📊 <b>Resoconto invio:</b>\n"
-                f"✅ Inviati: {success_count}/{len(beats)}\n"
-                f"❌ Falliti: {len(failed_beats)}\n\n"
-                f"<b>Beat non inviati:</b>\n{failed_list}\n\n"
-                "🔄 Riprova a contattare l'assistenza se alcuni beat non sono arrivati.\n"
-                "📞 Instagram: https://linktr.ee/ProdByPegasus\n\n"
-                "🔄 <b>Per tornare al catalogo digita /start</b>"
+            summary_msg = DELIVERY_SUMMARY_MESSAGE.format(
+                sent=success_count, total=len(beats), failed=len(failed_beats), failed_list=failed_list
             )
             await app_fastapi.bot.send_message(
                 chat_id=user_id,
@@ -498,75 +679,97 @@ async def send_beat_to_user(user_id, beat_title, bundle_id=None, order_type="bea
             # Messaggio di successo per bundle completi
             await app_fastapi.bot.send_message(
                 chat_id=user_id,
-                text=(
-                    f"🎉 <b>Bundle completato!</b>\n"
-                    f"✅ Tutti i {success_count} beat sono stati inviati con successo!\n\n"
-                    "📱 Ricorda di salvare i file nei messaggi salvati di Telegram.\n\n"
-                    "🔄 <b>Per tornare al catalogo digita /start</b>"
-                ),
+                text=BUNDLE_COMPLETED_MESSAGE.format(sent=success_count),
                 parse_mode="HTML"
             )
 
     except Exception as e:
-        import traceback
-        print(f"[ERROR] Errore generale invio beat: {e}")
-        traceback.print_exc()
+        logger.error("Errore generale invio beat: %s", e, exc_info=True)
         
         # Invia messaggio di errore generale
         await app_fastapi.bot.send_message(
             chat_id=user_id,
-            text=(
-                f"❌ <b>Errore durante l'invio dei beat</b>\n\n"
-                f"✅ Beat inviati: {success_count}/{len(beats)}\n"
-                f"❌ Errore: {str(e)}\n\n"
-                "🔄 Contatta l'assistenza per ricevere i beat mancanti.\n"
-                "📞 Instagram: https://linktr.ee/ProdByPegasus\n\n"
-                "🔄 <b>Per tornare al catalogo digita /start</b>"
-            ),
+            text=DELIVERY_ERROR_MESSAGE.format(sent=success_count, total=len(beats), error=str(e)),
             parse_mode="HTML"
         )
         return {"status": "partial_error", "message": f"Sent {success_count}/{len(beats)} beats", "error": str(e)}
 
-    # PULIZIA: Rimuovi dalla cache di processing
-    if transaction_id:
-        processing_key = f"processing_{user_id}_{beat_title}_{bundle_id or 'none'}"
-        if hasattr(app_fastapi, '_currently_processing') and processing_key in app_fastapi._currently_processing:
-            del app_fastapi._currently_processing[processing_key]
-            print(f"[INFO] Elaborazione {beat_title} completata - rimosso da cache processing")
-
     # **NUOVO: Segna come consegnato per evitare messaggi di attesa tardivi**
+    order_key = (user_id, beat_title, bundle_id)
     if success_count > 0:  # Se almeno un beat è stato inviato con successo
-        delivery_cache_key = f"delivered_{user_id}_{beat_title}"
-        if not hasattr(app_fastapi, '_delivered_orders_cache'):
-            app_fastapi._delivered_orders_cache = {}
-        app_fastapi._delivered_orders_cache[delivery_cache_key] = time.time()
-        print(f"[INFO] Ordine {beat_title} marcato come consegnato per user {user_id}")
+        _order_states[order_key] = (OrderState.DELIVERED, time.time())
+        logger.info("Ordine %s marcato come consegnato per user %s", beat_title, user_id)
+    elif _get_order_state(order_key, time.time())[0] is OrderState.PROCESSING:
+        # PULIZIA: nessun beat consegnato, l'ordine non è più in elaborazione
+        del _order_states[order_key]
+        logger.info("Elaborazione %s completata - rimosso stato processing", beat_title)
 
     # **Controllo finale del successo**
     if success_count == 0:
         # Nessun beat inviato con successo
-        print(f"[ERROR] Nessun beat inviato con successo per {beat_title}")
+        logger.error("Nessun beat inviato con successo per %s", beat_title)
         return {"status": "error", "message": f"Failed to send all beats", "sent": 0, "total": len(beats)}
     elif success_count < len(beats):
         # Alcuni beat inviati, altri falliti
-        print(f"[WARNING] Invio parziale: {success_count}/{len(beats)} beat inviati")
+        logger.warning("Invio parziale: %s/%s beat inviati", success_count, len(beats))
         return {"status": "partial", "message": f"Sent {success_count}/{len(beats)} beats", "sent": success_count, "total": len(beats)}
     else:
         # Tutti i beat inviati con successo
-        print(f"[SUCCESS] Tutti i {success_count} beat inviati con successo")
+        logger.info("Tutti i %s beat inviati con successo", success_count)
         return {"status": "ok", "message": f"All {success_count} beats sent successfully", "sent": success_count, "total": len(beats)}
 
+# Update di chat diverse processati in parallelo (fino a questo limite)
+MAX_CONCURRENT_UPDATES = 64
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processa in parallelo gli update di chat diverse, ma in ordine quelli della stessa chat:
+    una chat lenta non blocca le altre e il ConversationHandler vede gli stati in sequenza.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # Un lock per chat attiva: sparisce da solo quando nessuno lo usa più
+        self._chat_locks = WeakValueDictionary()
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await coroutine
+            return
+        lock = self._chat_locks.get(chat.id)
+        if lock is None:
+            lock = self._chat_locks[chat.id] = asyncio.Lock()
+        async with lock:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
 def main():
-    app = ApplicationBuilder().token(TOKEN).build()
+    # Il rate limiter distribuisce gli invii nei limiti di Telegram e ritenta in caso di 429
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .build()
+    )
     app.add_handler(conversation_handler)
     app_fastapi.bot = app.bot
+
+    # Indici del catalogo anche sui database creati prima della loro introduzione
+    ensure_beat_indexes()
     
     # Aggiungi un job per pulire le prenotazioni scadute ogni 5 minuti
     job_queue = app.job_queue
     
     async def cleanup_job(context):
         """Job asincrono per pulire le prenotazioni scadute"""
-        cleanup_expired_reservations()
+        await asyncio.to_thread(cleanup_expired_reservations)
     
     # Controlla se JobQueue è disponibile prima di usarlo
     if job_queue is not None:
@@ -576,42 +779,41 @@ def main():
             first=30,      # Avvia dopo 30 secondi
             name="cleanup_reservations"
         )
-        print("[INFO] JobQueue configurato per cleanup automatico prenotazioni")
+        logger.info("JobQueue configurato per cleanup automatico prenotazioni")
     else:
-        print("[WARNING] JobQueue non disponibile - cleanup automatico disabilitato")
+        logger.warning("JobQueue non disponibile - cleanup automatico disabilitato")
     
     # Usa la porta da variabile d'ambiente, default a 8080 (per locale)
     port = int(os.environ.get("PORT", 8080))
 
-    # Avvia FastAPI in un thread separato
-    threading.Thread(
-        target=lambda: uvicorn.run(app_fastapi, host="0.0.0.0", port=port, reload=False),
-        daemon=True
-    ).start()
+    # Bot Telegram e server FastAPI condividono lo stesso event loop (uvloop)
+    uvloop.run(run_bot_and_server(app, port))
 
-    # Aspetta che il server si avvii e sia pronto
-    import time
-    import requests
-    
-    print(f"[INFO] Avvio del server HTTP sulla porta {port}...")
-    time.sleep(5)  # Aumentato da 2 a 5 secondi
-    
-    # Verifica che il server sia pronto
-    max_retries = 10
-    for i in range(max_retries):
-        try:
-            response = requests.get(f"http://localhost:{port}/health", timeout=5)
-            if response.status_code == 200:
-                print(f"[INFO] Server HTTP pronto sulla porta {port}")
-                break
-        except Exception as e:
-            print(f"[INFO] Server non ancora pronto, tentativo {i+1}/{max_retries}")
-            time.sleep(2)
-    else:
-        print(f"[WARNING] Server HTTP potrebbe non essere pronto dopo {max_retries} tentativi")
+async def run_bot_and_server(app, port):
+    """Esegue il polling del bot Telegram e il server HTTP nello stesso event loop."""
+    # Il loop è già uvloop (creato da main); httptools esplicito per non ricadere su h11
+    server = uvicorn.Server(uvicorn.Config(app_fastapi, host="0.0.0.0", port=port, reload=False, http="httptools"))
+
+    async with app:  # initialize() / shutdown()
+        logger.info("Avvio del server HTTP sulla porta %s...", port)
+        # Termina alla ricezione di SIGINT/SIGTERM (gestiti da uvicorn)
+        server_task = asyncio.create_task(server.serve())
 
-    # Avvia il bot Telegram con polling (funziona sia locale che su server)
-    app.run_polling()
+        # Il polling parte solo quando il server HTTP è pronto a ricevere le notifiche interne
+        while not server.started:
+            if server_task.done():
+                await server_task  # Avvio fallito: propaga l'errore
+                return
+            await asyncio.sleep(0.05)
+
+        await app.start()
+        await app.updater.start_polling()
+        logger.info("Server HTTP avviato, polling Telegram attivo")
+        try:
+            await server_task
+        finally:
+            await app.updater.stop()
+            await app.stop()
 
 if __name__ == "__main__":
     main()
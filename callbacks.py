@@ -1,20 +1,29 @@
 # callbacks.py
 import os
+import asyncio
 import logging
 import time
 import random
+import math
+import orjson
+from functools import lru_cache
+from dataclasses import dataclass, field
+from typing import Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import ContextTypes, ConversationHandler
+from telegram.error import BadRequest
 from urllib.parse import quote  # <--- aggiungi questa importazione
 from utils import (
     build_keyboard,
-    build_dynamic_genre_to_moods,
+    get_genre_to_moods,
+    invalidate_genre_to_moods_cache,
     parse_genre_label,
     parse_mood_label,
     build_keyboard_with_disabled,
     show_loading,
     validate_url,
     is_user_blocked,
+    get_redis,
     blockeduser_response,
     create_paypal_order,
     LOADING_KEYBOARD,
@@ -26,6 +35,8 @@ from db_manager import (
 )
 from telegram.ext import JobQueue
 from telegram.constants import ParseMode
+from cachetools import TTLCache
+from sqlalchemy import select, bindparam, case, null
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -38,13 +49,13 @@ R2_CONFIG = get_r2_config()
 PAYPAL_CONFIG = get_paypal_config()
 
 # Variabili R2
-R2_ENDPOINT_URL = R2_CONFIG["endpoint_url"]
-R2_BUCKET_NAME = R2_CONFIG["bucket_name"]
-R2_PUBLIC_BASE = R2_CONFIG["public_base_url"]
+R2_ENDPOINT_URL = R2_CONFIG.endpoint_url
+R2_BUCKET_NAME = R2_CONFIG.bucket_name
+R2_PUBLIC_BASE = R2_CONFIG.public_base_url
 
 # Variabili PayPal
-PAYPAL_CLIENT_ID = PAYPAL_CONFIG["client_id"]
-PAYPAL_CLIENT_SECRET = PAYPAL_CONFIG["client_secret"]
+PAYPAL_CLIENT_ID = PAYPAL_CONFIG.client_id
+PAYPAL_CLIENT_SECRET = PAYPAL_CONFIG.client_secret
 
 # Helper functions
 def ensure_path(key, kind):
@@ -67,20 +78,19 @@ async def cleanup_user_reservation_and_payment(user_id, context, chat_id, reason
     Funzione helper per rilasciare prenotazioni attive e cancellare messaggi di pagamento.
     Utilizzata in tutti i percorsi di navigazione per garantire UX fluida.
     """
-    cleanup_expired_reservations()
-    has_reservation, reservation_info, reserved_beat_id = get_user_active_reservation(user_id)
+    has_reservation, reservation_info, reserved_beat_id = await asyncio.to_thread(_active_reservation, user_id)
     
     # Rilascia prenotazioni beat singoli
     if has_reservation and reserved_beat_id:
-        release_beat_reservation(reserved_beat_id, user_id)
-        print(f"DEBUG: Prenotazione beat rilasciata per utente {user_id}, beat {reserved_beat_id} - {reason}")
+        await asyncio.to_thread(release_beat_reservation, reserved_beat_id, user_id)
+        logger.debug("Prenotazione beat rilasciata per utente %s, beat %s - %s", user_id, reserved_beat_id, reason)
     
     # Rilascia prenotazioni bundle
     reserved_bundle_id = context.user_data.get("reserved_bundle_id")
     if reserved_bundle_id:
-        released_count = release_bundle_reservations(reserved_bundle_id, user_id)
+        released_count = await asyncio.to_thread(release_bundle_reservations, reserved_bundle_id, user_id)
         if released_count > 0:
-            print(f"DEBUG: {released_count} prenotazioni bundle rilasciate per utente {user_id}, bundle {reserved_bundle_id} - {reason}")
+            logger.debug("%s prenotazioni bundle rilasciate per utente %s, bundle %s - %s", released_count, user_id, reserved_bundle_id, reason)
         context.user_data.pop("reserved_bundle_id", None)
     
     # 🧹 CLEANUP MESSAGGI: Lista di tutti i tipi di messaggi da cancellare
@@ -91,45 +101,37 @@ async def cleanup_user_reservation_and_payment(user_id, context, chat_id, reason
         ("bundle_payment_message_id", "pagamento bundle")
     ]
     
+    # Raccoglie (message_id, tipo) da cancellare; le chiamate partono tutte insieme alla fine
+    to_delete = []
+
     # Cancella TUTTI i messaggi di avviso se sono una lista (più warning per utente)
     warning_ids = context.user_data.get("warning_message_id")
     if isinstance(warning_ids, list):
-        for wid in warning_ids:
-            try:
-                await context.bot.delete_message(
-                    chat_id=chat_id,
-                    message_id=wid
-                )
-                print(f"DEBUG: Messaggio avviso {wid} cancellato (lista) - {reason}")
-            except Exception as e:
-                print(f"DEBUG: Errore cancellazione messaggio avviso (lista): {e}")
+        to_delete.extend((wid, "avviso") for wid in warning_ids)
         context.user_data["warning_message_id"] = []
     elif warning_ids:
-        try:
-            await context.bot.delete_message(
-                chat_id=chat_id,
-                message_id=warning_ids
-            )
-            print(f"DEBUG: Messaggio avviso {warning_ids} cancellato - {reason}")
-        except Exception as e:
-            print(f"DEBUG: Errore cancellazione messaggio avviso: {e}")
+        to_delete.append((warning_ids, "avviso"))
         context.user_data.pop("warning_message_id", None)
 
     # Cancella altri tipi di messaggi
     for message_key, message_type in message_types_to_clean:
         if message_key == "warning_message_id":
             continue  # Già gestito sopra
-        message_id = context.user_data.get(message_key)
+        message_id = context.user_data.pop(message_key, None)
         if message_id:
-            try:
-                await context.bot.delete_message(
-                    chat_id=chat_id,
-                    message_id=message_id
-                )
-                print(f"DEBUG: Messaggio {message_type} {message_id} cancellato - {reason}")
-            except Exception as e:
-                print(f"DEBUG: Errore cancellazione messaggio {message_type}: {e}")
-            context.user_data.pop(message_key, None)
+            to_delete.append((message_id, message_type))
+
+    if to_delete:
+        # Un solo round trip di attesa invece di uno per messaggio
+        results = await asyncio.gather(
+            *(context.bot.delete_message(chat_id=chat_id, message_id=message_id) for message_id, _ in to_delete),
+            return_exceptions=True
+        )
+        for (message_id, message_type), result in zip(to_delete, results):
+            if isinstance(result, Exception):
+                logger.debug("Errore cancellazione messaggio %s: %s", message_type, result)
+            else:
+                logger.debug("Messaggio %s %s cancellato - %s", message_type, message_id, reason)
     
     # Pulisci anche altri dati temporanei del context
     temp_keys_to_clean = [
@@ -141,33 +143,217 @@ async def cleanup_user_reservation_and_payment(user_id, context, chat_id, reason
     for key in temp_keys_to_clean:
         context.user_data.pop(key, None)
 
+@lru_cache(maxsize=4096)
+def build_public_url(key, kind):
+    """URL pubblico R2 per una chiave (memoizzato: le chiavi dei beat non cambiano)"""
+    path = ensure_path(key, kind)
+    return f"{R2_PUBLIC_BASE}/{quote(path)}" if path else None
+
 def build_beat_urls(beat):
     """Costruisce gli URL per preview, file e immagine di un beat"""
-    preview_key = ensure_path(beat.preview_key, "preview")
-    file_key = ensure_path(beat.file_key, "file")
-    image_key = ensure_path(beat.image_key, "image")
-    
     return {
-        "preview_url": f"{R2_PUBLIC_BASE}/{quote(preview_key)}" if preview_key else None,
-        "file_url": f"{R2_PUBLIC_BASE}/{quote(file_key)}" if file_key else None,
-        "image_url": f"{R2_PUBLIC_BASE}/{quote(image_key)}" if image_key else None,
+        "preview_url": build_public_url(beat.preview_key, "preview"),
+        "file_url": build_public_url(beat.file_key, "file"),
+        "image_url": build_public_url(beat.image_key, "image"),
     }
 
+def _format_price(value):
+    return f"{value:.2f}€" if value is not None else None
+
+@dataclass(slots=True, frozen=True)
+class BeatView:
+    """Dati di un beat mostrati nel catalogo (condivisi tra gli utenti tramite get_beat_view)"""
+    id: int
+    title: str
+    genre: str
+    mood: str
+    price: float
+    original_price: Optional[float]
+    is_discounted: int
+    discount_percent: int
+    is_exclusive: int
+    preview_url: Optional[str]
+    file_url: Optional[str]
+    image_url: Optional[str]
+    # Prezzi già formattati per la caption, calcolati una volta alla creazione
+    price_str: Optional[str] = field(init=False)
+    original_price_str: Optional[str] = field(init=False)
+
+    def __post_init__(self):
+        # frozen=True: i campi derivati si impostano con object.__setattr__
+        object.__setattr__(self, "price_str", _format_price(self.price))
+        object.__setattr__(self, "original_price_str", _format_price(self.original_price))
+
 def create_beat_data(beat):
     """Crea i dati del beat con tutti gli URL necessari"""
-    urls = build_beat_urls(beat)
-    return {
-        "id": beat.id,  # Aggiungi l'ID per la gestione delle prenotazioni
-        "title": beat.title,
-        "genre": beat.genre,
-        "mood": beat.mood,
-        "price": beat.price,
-        "original_price": beat.original_price,
-        "is_discounted": beat.is_discounted,
-        "discount_percent": beat.discount_percent,
-        "is_exclusive": beat.is_exclusive,
-        **urls
-    }
+    return BeatView(
+        id=beat.id,  # ID per la gestione delle prenotazioni
+        title=beat.title,
+        genre=beat.genre,
+        mood=beat.mood,
+        price=beat.price,
+        original_price=beat.original_price,
+        # Conversioni fatte una volta qui invece che a ogni render della caption
+        is_discounted=int(beat.is_discounted or 0),
+        discount_percent=int(beat.discount_percent or 0),
+        is_exclusive=int(beat.is_exclusive or 0),
+        **build_beat_urls(beat)
+    )
+
+# Cache del catalogo per (categoria, genere, mood, fascia di prezzo): prev/next e i cambi
+# filtro non rieseguono la query finché la voce è valida
+CATALOG_CACHE_TTL = 60  # secondi
+_catalog_cache = TTLCache(maxsize=512, ttl=CATALOG_CACHE_TTL)
+
+# Fasce di prezzo dei filtri: (minimo, minimo incluso, massimo)
+PRICE_RANGES = {
+    "0-10€": (0, True, 10),
+    "10-20€": (10, False, 20),
+    "20-30€": (20, False, 30),
+    "30€+": (30, False, None),
+}
+
+# SELECT delle sole colonne lette da create_beat_data
+_CATALOG_COLUMNS = select(
+    Beat.id, Beat.title, Beat.genre, Beat.mood,
+    Beat.preview_key, Beat.file_key, Beat.image_key,
+    Beat.price, Beat.original_price, Beat.is_discounted, Beat.discount_percent, Beat.is_exclusive,
+)
+
+# Condizione SQL di ogni categoria, costruita una volta e condivisa da catalogo e pannelli filtri
+_CATEGORY_CONDS = {
+    "exclusive": Beat.is_exclusive == 1,
+    "discount": Beat.is_discounted == 1,
+    # Mostra tutti i beat NON esclusivi (sia scontati che non scontati)
+    "standard": Beat.is_exclusive == 0,
+}
+
+# Statement base per categoria, costruiti una volta: le query aggiungono solo i filtri opzionali.
+# I valori dei filtri diventano parametri, quindi SQLAlchemy riusa la compilazione in cache.
+_CATEGORY_STMTS = {
+    None: _CATALOG_COLUMNS,
+    **{category: _CATALOG_COLUMNS.where(cond) for category, cond in _CATEGORY_CONDS.items()},
+}
+
+# BeatView condivisi tra tutti gli utenti: in user_data restano solo gli ID dei beat
+_beat_views = TTLCache(maxsize=2048, ttl=CATALOG_CACHE_TTL)
+_BEAT_VIEW_STMT = _CATALOG_COLUMNS.where(Beat.id == bindparam("beat_id"))
+
+def invalidate_catalog_cache():
+    """Svuota la cache del catalogo (da chiamare dopo modifiche ai beat)"""
+    _catalog_cache.clear()
+    _beat_views.clear()
+    _filter_rows_cache.clear()
+    invalidate_genre_to_moods_cache()
+    _drop_shared_filter_rows()
+
+def _query_beat_view(beat_id):
+    """Legge un singolo beat dal database (sincrona: eseguita in un thread)"""
+    with SessionLocal() as session:
+        row = session.execute(_BEAT_VIEW_STMT, {"beat_id": beat_id}).first()
+    return create_beat_data(row) if row is not None else None
+
+async def get_beat_view(beat_id):
+    """Restituisce il BeatView di un beat (dalla cache o con una query mirata), None se non esiste più"""
+    view = _beat_views.get(beat_id)
+    if view is None:
+        # La query gira in un thread; la cache viene aggiornata solo dall'event loop
+        view = await asyncio.to_thread(_query_beat_view, beat_id)
+        if view is not None:
+            _beat_views[beat_id] = view
+    return view
+
+def _active_reservation(user_id):
+    """Pulisce le prenotazioni scadute e restituisce quella attiva dell'utente (sincrona: in un thread)"""
+    cleanup_expired_reservations()
+    return get_user_active_reservation(user_id)
+
+def _random_order(n):
+    """
+    Ordine pseudo-casuale di n beat come mappa affine i -> (a*i + b) % n: con a coprimo
+    con n è una permutazione di [0, n), quindi non serve copiare e mescolare la lista.
+    """
+    if n <= 1:
+        return (1, 0)
+    a = random.randrange(1, n)
+    while math.gcd(a, n) != 1:
+        a = a % (n - 1) + 1  # Prima o poi arriva a 1, sempre coprimo
+    return (a, random.randrange(n))
+
+def _beat_id_at(context, idx):
+    """ID del beat in posizione idx secondo l'ordine salvato per l'utente"""
+    beat_ids = context.user_data["beat_ids"]
+    a, b = context.user_data.get("beat_order", (1, 0))
+    return beat_ids[(a * idx + b) % len(beat_ids)]
+
+async def _current_beat(context):
+    """BeatView del beat attualmente mostrato all'utente"""
+    return await get_beat_view(_beat_id_at(context, context.user_data["beat_index"]))
+
+def _drop_beat_from_navigation(context, beat_id):
+    """
+    Toglie un beat non più esistente dalla navigazione di questo utente e restituisce gli ID rimasti.
+    L'ordine del database resta tale; un ordine casuale viene ricalcolato sulla nuova lunghezza.
+    """
+    beat_ids = tuple(i for i in context.user_data["beat_ids"] if i != beat_id)
+    context.user_data["beat_ids"] = beat_ids
+    if beat_ids:
+        if context.user_data.get("beat_order", (1, 0)) != (1, 0):
+            context.user_data["beat_order"] = _random_order(len(beat_ids))
+        context.user_data["beat_index"] %= len(beat_ids)
+    return beat_ids
+
+async def _load_beat_ids(category, genre, mood, price_range):
+    """
+    Restituisce gli ID dei beat che corrispondono ai filtri (i BeatView finiscono in _beat_views).
+    category None = nessun filtro di categoria. La tupla in cache è immutabile e condivisa
+    tra gli utenti: l'ordine di visualizzazione è applicato a parte con _beat_id_at.
+    """
+    key = (category, genre, mood, price_range)
+    cached = _catalog_cache.get(key)
+    if cached is not None:
+        return cached
+
+    # La query gira in un thread; le cache vengono aggiornate solo dall'event loop
+    beats = await asyncio.to_thread(_query_beats, category, genre, mood, price_range)
+    _beat_views.update((beat.id, beat) for beat in beats)
+    beat_ids = _catalog_cache[key] = tuple(beat.id for beat in beats)
+    return beat_ids
+
+def _query_beats(category, genre, mood, price_range):
+    """Esegue la query del catalogo (sincrona: eseguita in un thread)"""
+    stmt = _CATEGORY_STMTS[category]
+
+    # Applica filtri indipendenti
+    if genre:
+        stmt = stmt.where(Beat.genre == genre)
+    if mood:
+        stmt = stmt.where(Beat.mood == mood)
+    bounds = PRICE_RANGES.get(price_range)
+    if bounds:
+        low, low_inclusive, high = bounds
+        stmt = stmt.where(Beat.price >= low if low_inclusive else Beat.price > low)
+        if high is not None:
+            stmt = stmt.where(Beat.price <= high)
+
+    # Righe con le sole colonne usate: nessuna istanza ORM né lazy load per beat
+    with SessionLocal() as session:
+        return [create_beat_data(row) for row in session.execute(stmt)]
+
+# Task di cancellazione in corso: il riferimento evita che vengano raccolti dal GC prima della fine
+_background_deletes = set()
+
+def delete_message_in_background(bot, chat_id, message_id, label="messaggio"):
+    """Cancella un messaggio senza attendere l'esito: chi chiama non ne ha bisogno"""
+    task = asyncio.create_task(bot.delete_message(chat_id=chat_id, message_id=message_id))
+    _background_deletes.add(task)
+
+    def _done(t):
+        _background_deletes.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            logger.debug("Errore cancellazione %s: %s", label, t.exception())
+
+    task.add_done_callback(_done)
 
 async def check_user_blocked(update, context):
     """Controlla se l'utente è bloccato e gestisce la risposta"""
@@ -225,6 +411,16 @@ Il nostro catalogo completo di qualità.
 👇 <b>Inizia la tua ricerca musicale:</b>
 """
 
+# Tastiera con le quattro categorie (statica: costruita una volta all'import)
+WELCOME_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(text=btn, callback_data=btn) for btn in row]
+    for row in (
+        ["🎶 Beat standard"],
+        ["💸 Beat scontati", "🎖️ Beat esclusivi"],
+        ["🎁 Bundle promozionali"]
+    )
+])
+
 async def send_welcome_message(update, context, edit=False):
     if await check_user_blocked(update, context):
         return
@@ -233,7 +429,7 @@ async def send_welcome_message(update, context, edit=False):
     reserved_beat_id = context.user_data.get("reserved_beat_id")
     if reserved_beat_id:
         user_id = update.effective_user.id
-        release_beat_reservation(reserved_beat_id, user_id)
+        await asyncio.to_thread(release_beat_reservation, reserved_beat_id, user_id)
         context.user_data.pop("reserved_beat_id", None)
 
     # Reset filtri utente quando si torna al menu principale
@@ -241,17 +437,7 @@ async def send_welcome_message(update, context, edit=False):
     context.user_data.pop("mood", None)
     context.user_data.pop("price_range", None)
 
-    # Tastiera con le quattro categorie
-    keyboard = [
-        ["🎶 Beat standard"],
-        ["💸 Beat scontati", "🎖️ Beat esclusivi"],
-        ["🎁 Bundle promozionali"]
-    ]
-    reply_markup = InlineKeyboardMarkup([
-        [InlineKeyboardButton(text=btn, callback_data=btn) for btn in row]
-        for row in keyboard
-    ])
-
+    reply_markup = WELCOME_MARKUP
     text = WELCOME_TEXT
 
     chat = update.effective_chat
@@ -262,10 +448,7 @@ async def send_welcome_message(update, context, edit=False):
     # Cancella vecchio menu (se esiste)
     old_msg_id = context.user_data.get("last_bot_message_id")
     if old_msg_id:
-        try:
-            await context.bot.delete_message(chat_id=chat.id, message_id=old_msg_id)
-        except Exception as e:
-            logger.debug(f"Errore cancellazione vecchio menu: {e}")
+        delete_message_in_background(context.bot, chat.id, old_msg_id, "vecchio menu")
 
     # Invia nuovo menu delle categorie
     sent = await chat.send_message(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
@@ -321,12 +504,12 @@ async def genre_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if "mood" in context.user_data:
         context.user_data.pop("mood", None)
-    if "beats" in context.user_data:
-        context.user_data.pop("beats", None)
+    if "beat_ids" in context.user_data:
+        context.user_data.pop("beat_ids", None)
     if "beat_index" in context.user_data:
         context.user_data.pop("beat_index", None)
 
-    genre_to_moods = build_dynamic_genre_to_moods()
+    genre_to_moods = await get_genre_to_moods()
     moods = genre_to_moods.get(genre_label, [])
     keyboard = build_keyboard_with_disabled(moods, back_button=True, context_key=genre)
     
@@ -352,7 +535,7 @@ async def mood_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # ⚡ CLEANUP: Rilascia prenotazioni quando si torna indietro dal mood
         await cleanup_user_reservation_and_payment(user_id, context, update.effective_chat.id, "ritorno da mood a genere")
         
-        genre_to_moods = build_dynamic_genre_to_moods()
+        genre_to_moods = await get_genre_to_moods()
         keyboard = build_keyboard_with_disabled(list(genre_to_moods.keys()))
         reply_markup = InlineKeyboardMarkup(keyboard)
         text = WELCOME_TEXT
@@ -374,14 +557,20 @@ async def mood_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     mood = parse_mood_label(data)
     context.user_data["mood"] = mood
 
-    with SessionLocal() as session:
-        beats = session.query(Beat).filter_by(genre=genre, mood=mood).all()
-
-    context.user_data["beats"] = [create_beat_data(beat) for beat in beats]
+    context.user_data["beat_ids"] = await _load_beat_ids(None, genre, mood, None)
+    context.user_data["beat_order"] = (1, 0)  # Ordine del database, senza mescolare
     context.user_data["beat_index"] = 0
     context.user_data["current_state"] = BEAT_SELECTION
     return await show_beat_catalog(update, context)
 
+# Bottoni del menu principale -> categoria del catalogo
+_CATEGORY_MAP = {
+    "🎶 Beat standard": "standard",
+    "💸 Beat scontati": "discount",
+    "🎖️ Beat esclusivi": "exclusive",
+    "🎁 Bundle promozionali": "bundles",
+}
+
 async def category_selected(update, context):
     if await check_user_blocked(update, context):
         return CATEGORY
@@ -406,140 +595,111 @@ async def category_selected(update, context):
     context.user_data.pop("price_range", None)
 
     # Salva la categoria scelta
-    if data == "🎶 Beat standard":
-        context.user_data["catalog_category"] = "standard"
-    elif data == "💸 Beat scontati":
-        context.user_data["catalog_category"] = "discount"
-    elif data == "🎖️ Beat esclusivi":
-        context.user_data["catalog_category"] = "exclusive"
-    elif data == "🎁 Bundle promozionali":
-        context.user_data["catalog_category"] = "bundles"
-        await query.answer()
-        return await show_bundles_catalog(update, context)
-    else:
+    category = _CATEGORY_MAP.get(data)
+    if category is None:
         await query.answer("Categoria non valida.", show_alert=True)
         return CATEGORY
+    context.user_data["catalog_category"] = category
+    if category == "bundles":
+        await query.answer()
+        return await show_bundles_catalog(update, context)
 
     await query.answer()
     # Mostra subito il catalogo filtrato (shuffle)
     return await show_filtered_catalog(update, context)
 
+async def _show_empty_catalog(query, context):
+    """Mostra il messaggio di catalogo vuoto con il bottone per tornare al menu"""
+    await _answer_callback(query)
+    context.user_data.pop("beat_ids", None)
+    try:
+        # Aggiorna il messaggio con testo e bottone per tornare al menu
+        await query.edit_message_text(
+            "❌ Nessun beat disponibile per questa categoria.",
+            reply_markup=EMPTY_CATALOG_MARKUP,
+            parse_mode="HTML"
+        )
+    except Exception:
+        pass
+    context.user_data["current_state"] = CATEGORY
+    return CATEGORY
+
 async def show_filtered_catalog(update, context):
     """Mostra il catalogo filtrato in base alla categoria scelta, con UI a scorrimento e filtri"""
-    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-    
     user_id = update.effective_user.id
-    
-    # ⚡ CLEANUP AUTOMATICO: Rilascia prenotazioni e cancella messaggi quando si visualizza il catalogo filtrato
-    await cleanup_user_reservation_and_payment(user_id, context, update.effective_chat.id, "visualizzazione catalogo filtrato")
 
     category = context.user_data.get("catalog_category")
     genre_filter = context.user_data.get("genre")
     mood_filter = context.user_data.get("mood")
     price_range = context.user_data.get("price_range")
 
-    with SessionLocal() as session:
-        query = session.query(Beat)
-        if category == "exclusive":
-            query = query.filter(Beat.is_exclusive == 1)
-        elif category == "discount":
-            query = query.filter(Beat.is_discounted == 1)
-        else:  # standard
-            # Mostra tutti i beat NON esclusivi (sia scontati che non scontati)
-            query = query.filter(Beat.is_exclusive == 0)
-
-        # Applica filtri indipendenti
-        if genre_filter:
-            query = query.filter(Beat.genre == genre_filter)
-        if mood_filter:
-            query = query.filter(Beat.mood == mood_filter)
-        if price_range and price_range != "Tutti":
-            if price_range == "0-10€":
-                query = query.filter(Beat.price >= 0, Beat.price <= 10)
-            elif price_range == "10-20€":
-                query = query.filter(Beat.price > 10, Beat.price <= 20)
-            elif price_range == "20-30€":
-                query = query.filter(Beat.price > 20, Beat.price <= 30)
-            elif price_range == "30€+":
-                query = query.filter(Beat.price > 30)
-        beats = query.all()
-
-    # Shuffle i beat
-    import random
-    beats = list(beats)
-    random.shuffle(beats)
-
-    # Salva i beat filtrati in user_data per la navigazione
-    context.user_data["beats"] = [create_beat_data(beat) for beat in beats]
+    # Le categorie non riconosciute ricadono nello standard
+    if category not in ("exclusive", "discount"):
+        category = "standard"
+
+    # ⚡ CLEANUP AUTOMATICO: Rilascia prenotazioni e cancella messaggi quando si visualizza il catalogo filtrato.
+    # Il cleanup non influisce sul catalogo, quindi gira in parallelo al caricamento degli ID
+    # (solo gli ID in user_data: i dati restano nella cache condivisa)
+    _, beat_ids = await asyncio.gather(
+        cleanup_user_reservation_and_payment(user_id, context, update.effective_chat.id, "visualizzazione catalogo filtrato"),
+        _load_beat_ids(category, genre_filter, mood_filter, price_range),
+    )
 
     query = update.callback_query
-    if not context.user_data["beats"]:
-        # Aggiorna il messaggio con testo e bottone per tornare al menu
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔙 Torna al menu", callback_data="menu")]
-        ])
-        try:
-            await query.edit_message_text(
-                "❌ Nessun beat disponibile per questa categoria.",
-                reply_markup=keyboard,
-                parse_mode="HTML"
-            )
-        except Exception:
-            pass
-        context.user_data["current_state"] = CATEGORY
-        return CATEGORY
+    if not beat_ids:
+        # Nessun risultato (combinazioni di filtri vuote sono frequenti): esci prima di preparare la navigazione
+        return await _show_empty_catalog(query, context)
+
+    # Salva i beat filtrati in user_data per la navigazione, con un ordine casuale nuovo
+    # per ogni visualizzazione (permutazione calcolata indice per indice)
+    context.user_data["beat_ids"] = beat_ids
+    context.user_data["beat_order"] = _random_order(len(beat_ids))
 
     context.user_data["beat_index"] = 0
     context.user_data["current_state"] = BEAT_SELECTION
     return await show_beat_catalog(update, context)
 
+# Blocchi fissi della caption del beat
+EXCLUSIVE_HEADER = (
+    "<b>🔒 <u>DISPONIBILITÀ LIMITATA</u> 🔒</b>\n"
+    "<b>Questo beat è <u>unico</u> e acquistabile una sola volta!</b>\n\n"
+)
+DISCOUNT_FMT = (
+    "<b>🔥 <u>OFFERTA LIMITATA!</u> 🔥</b>\n"
+    "<b>Prezzo: <s>{original_price}</s> → <u>{price}</u></b>\n"
+    "<b>Sconto del {discount_percent}% 💸</b>"
+)
+PRICE_FMT = "<b>💰 <u>PREZZO: {price}</u></b>"
+
 def build_beat_caption(beat, idx, filtri_str):
     """
     Restituisce la caption HTML per un beat, mostrando badge e messaggi per sconto/esclusività.
     """
-    title = beat.get("title")
-    genre = beat.get("genre")
-    mood = beat.get("mood")
-    price = beat.get("price", 19.99)
-    original_price = beat.get("original_price", None)
-    is_discounted = int(beat.get("is_discounted", 0))
-    discount_percent = int(beat.get("discount_percent", 0))
-    is_exclusive = int(beat.get("is_exclusive", 0))
-
-    lines = []
-
-    # Esclusivo: messaggio in alto
-    if is_exclusive == 1:
-        lines.append("<b>🔒 <u>DISPONIBILITÀ LIMITATA</u> 🔒</b>")
-        lines.append("<b>Questo beat è <u>unico</u> e acquistabile una sola volta!</b>")
-        lines.append("")  # Riga vuota per separazione
-
-    # Titolo beat
-    lines.append(f"🎵 <u>#{idx+1}</u> • <b>{title}</b>")
+    price = beat.price
+    original_price = beat.original_price
 
     # Sconto
     if (
-        is_discounted == 1
-        and discount_percent > 0
+        beat.is_discounted == 1
+        and beat.discount_percent > 0
         and original_price is not None
         and price is not None
         and float(price) < float(original_price)
     ):
-        lines.append("")
-        lines.append("<b>🔥 <u>OFFERTA LIMITATA!</u> 🔥</b>")
-        lines.append(f"<b>Prezzo: <s>{original_price:.2f}€</s> → <u>{price:.2f}€</u></b>")
-        lines.append(f"<b>Sconto del {discount_percent}% 💸</b>")
+        price_block = DISCOUNT_FMT.format(
+            original_price=beat.original_price_str, price=beat.price_str, discount_percent=beat.discount_percent
+        )
     else:
-        lines.append("")
-        lines.append(f"<b>💰 <u>PREZZO: {price:.2f}€</u></b>")
-
-    # Info generali
-    lines.append("")
-    lines.append(f"Genere: <b>{genre}</b>")
-    lines.append(f"Mood: <b>{mood}</b>")
-
-    caption = f"{filtri_str}" + "\n".join(lines)
-    return caption
+        price_block = PRICE_FMT.format(price=beat.price_str)
+
+    # Esclusivo: messaggio in alto; poi titolo, prezzo e info generali
+    return (
+        f"{filtri_str}{EXCLUSIVE_HEADER if beat.is_exclusive == 1 else ''}"
+        f"🎵 <u>#{idx+1}</u> • <b>{beat.title}</b>\n\n"
+        f"{price_block}\n\n"
+        f"Genere: <b>{beat.genre}</b>\n"
+        f"Mood: <b>{beat.mood}</b>"
+    )
 
 async def show_beat_catalog(update, context):
     if await check_user_blocked(update, context):
@@ -549,22 +709,24 @@ async def show_beat_catalog(update, context):
     user_id = update.effective_user.id
     
     # ⚡ CLEANUP AUTOMATICO: Se l'utente naviga, cancella prenotazioni precedenti
-    # Questo permette navigazione libera ma evita prenotazioni multiple
-    cleanup_expired_reservations()
-    has_reservation, reservation_info, reserved_beat_id = get_user_active_reservation(user_id)
+    # Questo permette navigazione libera ma evita prenotazioni multiple.
+    # Prenotazione attiva e beat da mostrare sono indipendenti: letti in parallelo
+    (has_reservation, reservation_info, reserved_beat_id), beat = await asyncio.gather(
+        asyncio.to_thread(_active_reservation, user_id),
+        get_beat_view(_beat_id_at(context, context.user_data["beat_index"])),
+    )
     
     if has_reservation:
-        beats = context.user_data.get("beats", [])
+        beat_ids = context.user_data.get("beat_ids", [])
         idx = context.user_data.get("beat_index", 0)
         
-        if beats and idx < len(beats):
-            current_beat = beats[idx]
-            current_beat_id = current_beat.get("id")
+        if beat_ids and idx < len(beat_ids):
+            current_beat_id = _beat_id_at(context, idx)
             
             # Se l'utente sta navigando verso un beat diverso, cancella la prenotazione precedente
             if reserved_beat_id != current_beat_id:
                 # Rilascia la prenotazione precedente
-                release_beat_reservation(reserved_beat_id, user_id)
+                await asyncio.to_thread(release_beat_reservation, reserved_beat_id, user_id)
                 
                 # Cancella il messaggio di pagamento precedente se esiste
                 previous_payment_msg_id = context.user_data.get("payment_message_id")
@@ -579,14 +741,20 @@ async def show_beat_catalog(update, context):
                     
                     context.user_data.pop("payment_message_id", None)
                 
-                print(f"DEBUG: Prenotazione precedente cancellata - utente naviga da beat {reserved_beat_id} a beat {current_beat_id}")
+                logger.debug("Prenotazione precedente cancellata - utente naviga da beat %s a beat %s", reserved_beat_id, current_beat_id)
     
-    await query.answer()
-    await show_loading(query)
+    while beat is None:
+        # Beat rimosso dal database nel frattempo: lo toglie solo dalla navigazione di questo
+        # utente, senza toccare le cache condivise (scadono da sole) né cambiare flusso
+        if not _drop_beat_from_navigation(context, _beat_id_at(context, context.user_data["beat_index"])):
+            return await _show_empty_catalog(query, context)
+        beat = await _current_beat(context)
 
-    beats = context.user_data["beats"]
+    beat_ids = context.user_data["beat_ids"]
     idx = context.user_data["beat_index"]
-    beat = beats[idx]
+
+    await _answer_callback(query)
+    await show_loading(query)
 
     # Ricava filtri attivi (escludi la categoria di base)
     filtri = []
@@ -613,87 +781,96 @@ async def show_beat_catalog(update, context):
     caption = build_beat_caption(beat, idx, filtri_str)
 
     # Costruisci la tastiera
-    keyboard = build_navigation_keyboard(beats)
+    keyboard = build_navigation_keyboard(beat_ids)
     
     # Aggiungi il pulsante "Rimuovi filtri" se ci sono filtri attivi
     has_active_filters = any([genre, mood, price_range and price_range != "Tutti"])
     if has_active_filters:
         # Inserisci il pulsante "Rimuovi filtri" prima del "Torna al menu"
-        keyboard.insert(-1, [InlineKeyboardButton("🗑️ Rimuovi filtri di ricerca", callback_data="remove_all_filters")])
+        keyboard.insert(-1, REMOVE_FILTERS_ROW)
 
     try:
-        await update_message_with_beat(query, beat, caption, keyboard)
+        await update_message_with_beat(query, beat, caption, keyboard, context.user_data)
+        # Beat mostrato in questo messaggio: prev/next che ricadono sullo stesso beat non lo ridisegnano
+        context.user_data["last_rendered_beat"] = (query.message.message_id, beat.id)
     except Exception as e:
         logger.error(f"Errore generale show_beat_catalog: {e}")
+        context.user_data.pop("last_rendered_beat", None)
     
     # Reset preview tracking per ogni cambio beat
     context.user_data["last_preview_idx"] = None
     context.user_data["current_state"] = BEAT_SELECTION
     return BEAT_SELECTION
 
-def build_navigation_keyboard(beats):
+# Righe della tastiera di navigazione: i bottoni sono immutabili e condivisi tra i render
+NAV_ROW_SINGLE = (
+    InlineKeyboardButton("🚫 Indietro", callback_data="disabled_prev"),
+    InlineKeyboardButton("🚫 Avanti", callback_data="disabled_next")
+)
+NAV_ROW_MULTI = (
+    InlineKeyboardButton("⬅️ Indietro", callback_data="prev"),
+    InlineKeyboardButton("➡️ Avanti", callback_data="next")
+)
+PREVIEW_ROW = (InlineKeyboardButton("🎧 Spoiler", callback_data="preview"),)
+BUY_ROW = (InlineKeyboardButton("💸 Acquista", callback_data="buy"),)
+FILTER_ROW = (
+    InlineKeyboardButton("📞 Contattaci", url="https://linktr.ee/ProdByPegasus"),
+    InlineKeyboardButton("🔎 Filtri di ricerca", callback_data="change_filters")
+)
+REMOVE_FILTERS_ROW = (InlineKeyboardButton("🗑️ Rimuovi filtri di ricerca", callback_data="remove_all_filters"),)
+MENU_ROW = (InlineKeyboardButton("🔙 Torna al menu", callback_data="menu"),)
+EMPTY_CATALOG_MARKUP = InlineKeyboardMarkup([MENU_ROW])
+
+def build_navigation_keyboard(beat_ids):
     """Costruisce la tastiera di navigazione per i beat"""
     # Gestione tasti avanti/indietro disabilitati se c'è solo un beat
-    if len(beats) == 1:
-        nav_row = [
-            InlineKeyboardButton("🚫 Indietro", callback_data="disabled_prev"),
-            InlineKeyboardButton("🚫 Avanti", callback_data="disabled_next")
-        ]
-    else:
-        nav_row = [
-            InlineKeyboardButton("⬅️ Indietro", callback_data="prev"),
-            InlineKeyboardButton("➡️ Avanti", callback_data="next")
-        ]
+    nav_row = NAV_ROW_SINGLE if len(beat_ids) == 1 else NAV_ROW_MULTI
+    return [nav_row, PREVIEW_ROW, BUY_ROW, FILTER_ROW, MENU_ROW]
 
-    filter_row = [
-        InlineKeyboardButton("📞 Contattaci", url="https://linktr.ee/ProdByPegasus"),
-        InlineKeyboardButton("🔎 Filtri di ricerca", callback_data="change_filters")
-    ]
-
-    keyboard = [
-        nav_row,
-        [InlineKeyboardButton("🎧 Spoiler", callback_data="preview")],
-        [InlineKeyboardButton("💸 Acquista", callback_data="buy")],
-        filter_row,
-        [InlineKeyboardButton("🔙 Torna al menu", callback_data="menu")]
-    ]
-    
-    return keyboard
-
-async def update_message_with_beat(query, beat, caption, keyboard):
-    """Aggiorna il messaggio con l'immagine e i dettagli del beat"""
-    image_url = beat.get("image_url")
+async def update_message_with_beat(query, beat, caption, keyboard, user_data=None):
+    """
+    Aggiorna il messaggio con l'immagine e i dettagli del beat.
+    user_data (opzionale) ricorda quale immagine mostra il messaggio: se non cambia,
+    basta modificare caption e tastiera senza far riscaricare la foto a Telegram.
+    """
+    image_url = beat.image_url
     reply_markup = InlineKeyboardMarkup(keyboard)
+    message_id = query.message.message_id if query.message else None
+    if user_data is None:
+        user_data = {}
     
-    if image_url and validate_url(image_url):
-        from random import randint
-        sep = '&' if '?' in image_url else '?'
-        image_url_refresh = f"{image_url}{sep}_={randint(1, 999999)}"
-        
+    if image_url and await validate_url(image_url):
+        if user_data.get("last_image") == (message_id, image_url):
+            try:
+                await query.edit_message_caption(
+                    caption=caption, parse_mode='HTML', reply_markup=reply_markup
+                )
+                return
+            except Exception as ex:
+                logger.debug("Errore modifica caption, aggiorno la foto: %s", ex)
+
+        # URL stabile (senza cache-buster): Telegram può riusare la copia già scaricata
         try:
             await query.edit_message_media(
-                media=InputMediaPhoto(image_url_refresh, caption=caption, parse_mode='HTML'),
+                media=InputMediaPhoto(image_url, caption=caption, parse_mode='HTML'),
                 reply_markup=reply_markup
             )
         except Exception:
+            # Fallback: elimina e ricrea il messaggio
             try:
-                await query.edit_message_media(
-                    media=InputMediaPhoto(image_url, caption=caption, parse_mode='HTML'),
-                    reply_markup=reply_markup
-                )
-            except Exception:
-                # Fallback: elimina e ricrea il messaggio
-                try:
-                    await query.message.delete()
-                except Exception as ex:
-                    logger.debug(f"Errore eliminazione messaggio: {ex}")
-                await query.message.chat.send_photo(
-                    photo=image_url,
-                    caption=caption,
-                    parse_mode='HTML',
-                    reply_markup=reply_markup
-                )
+                await query.message.delete()
+            except Exception as ex:
+                logger.debug("Errore eliminazione messaggio: %s", ex)
+            sent = await query.message.chat.send_photo(
+                photo=image_url,
+                caption=caption,
+                parse_mode='HTML',
+                reply_markup=reply_markup
+            )
+            message_id = sent.message_id
+        user_data["last_image"] = (message_id, image_url)
     else:
+        user_data.pop("last_image", None)
         try:
             await query.edit_message_text(
                 caption, reply_markup=reply_markup, parse_mode='HTML'
@@ -702,7 +879,7 @@ async def update_message_with_beat(query, beat, caption, keyboard):
             try:
                 await query.message.delete()
             except Exception as ex:
-                logger.debug(f"Errore eliminazione messaggio: {ex}")
+                logger.debug("Errore eliminazione messaggio: %s", ex)
             await query.message.chat.send_message(
                 caption, reply_markup=reply_markup, parse_mode='HTML'
             )
@@ -713,7 +890,7 @@ async def handle_beat_navigation(update: Update, context: ContextTypes.DEFAULT_T
     
     query = update.callback_query
     data = query.data
-    beats = context.user_data["beats"]
+    beat_ids = context.user_data["beat_ids"]
     idx = context.user_data["beat_index"]
     user_id = update.effective_user.id
 
@@ -723,7 +900,9 @@ async def handle_beat_navigation(update: Update, context: ContextTypes.DEFAULT_T
         context.user_data["current_state"] = BEAT_SELECTION
         return BEAT_SELECTION
 
-    # Gestione spoiler: NON chiamare query.answer() qui, lasciato a send_beat_preview
+    # Gestione spoiler: NON chiamare query.answer() qui, lasciato a send_beat_preview.
+    # L'invio resta dentro l'handler: il lock per chat serializza i tap ripetuti e prev/next,
+    # quindi il controllo sulla preview già inviata non va in race
     if data == "preview":
         context.user_data["current_state"] = BEAT_SELECTION
         return await send_beat_preview(update, context)
@@ -767,10 +946,10 @@ async def handle_beat_navigation(update: Update, context: ContextTypes.DEFAULT_T
         await cleanup_user_reservation_and_payment(user_id, context, update.effective_chat.id, "navigazione tra beat")
 
     if data == "prev":
-        context.user_data["beat_index"] = (idx - 1) % len(beats)
+        context.user_data["beat_index"] = (idx - 1) % len(beat_ids)
         await delete_last_preview(context)
     elif data == "next":
-        context.user_data["beat_index"] = (idx + 1) % len(beats)
+        context.user_data["beat_index"] = (idx + 1) % len(beat_ids)
         await delete_last_preview(context)
     elif data == "buy":
         context.user_data["current_state"] = BEAT_SELECTION
@@ -778,6 +957,13 @@ async def handle_beat_navigation(update: Update, context: ContextTypes.DEFAULT_T
     
     # ⚡ FIX: Solo mostra il catalogo se NON è un acquisto
     context.user_data["current_state"] = BEAT_SELECTION
+
+    # Con un solo beat prev/next tornano sullo stesso: il messaggio lo mostra già,
+    # quindi niente schermata di caricamento né edit verso Telegram
+    if data in ("prev", "next") and context.user_data.get("last_rendered_beat") == (
+        query.message.message_id, _beat_id_at(context, context.user_data["beat_index"])
+    ):
+        return BEAT_SELECTION
     return await show_beat_catalog(update, context)
 
 async def send_beat_preview(update, context):
@@ -789,7 +975,10 @@ async def send_beat_preview(update, context):
 
     query = update.callback_query
     idx = context.user_data["beat_index"]
-    beat = context.user_data["beats"][idx]
+    beat = await _current_beat(context)
+    if beat is None:
+        await query.answer("❌ Questo beat non è più disponibile.", show_alert=True)
+        return BEAT_SELECTION
 
     # Se la preview per questo beat è già stata inviata, mostra pop-up e non reinvia
     if context.user_data.get("last_preview_idx") == idx and context.user_data.get("last_preview_message_id"):
@@ -803,8 +992,8 @@ async def send_beat_preview(update, context):
 
     try:
         sent = await query.message.reply_audio(
-            audio=beat["preview_url"],
-            caption=f"🎧 Preview di *{beat['title']}*",
+            audio=beat.preview_url,
+            caption=f"🎧 Preview di *{beat.title}*",
             parse_mode='Markdown',
         )
         context.user_data["last_preview_message_id"] = sent.message_id
@@ -828,11 +1017,8 @@ async def delete_last_preview(context):
         # Fallback: cerca in context.user_data
         if not chat_id:
             chat_id = context.user_data.get("chat_id")
-        try:
-            if chat_id:
-                await bot.delete_message(chat_id=chat_id, message_id=message_id)
-        except Exception as e:
-            logger.debug(f"Errore cancellazione preview: {e}")
+        if chat_id:
+            delete_message_in_background(bot, chat_id, message_id, "preview")
         # Rimuovi tracking
         context.user_data["last_preview_message_id"] = None
         context.user_data["last_preview_idx"] = None
@@ -844,16 +1030,18 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    idx = context.user_data["beat_index"]
-    beat = context.user_data["beats"][idx]
+    beat = await _current_beat(context)
     user_id = update.effective_user.id
+    if beat is None:
+        await query.message.reply_text("❌ Questo beat non è più disponibile.")
+        context.user_data["current_state"] = BEAT_SELECTION
+        return BEAT_SELECTION
 
     # ⚡ CONTROLLO PREVENTIVO FORTE: Verifica SUBITO se l'utente ha prenotazioni attive
     # Questo previene qualsiasi race condition o problema di cache
-    cleanup_expired_reservations()  # Pulisci prima di controllare
-    has_reservation, reservation_info, reserved_beat_id = get_user_active_reservation(user_id)
+    has_reservation, reservation_info, reserved_beat_id = await asyncio.to_thread(_active_reservation, user_id)
     if has_reservation:
-        beat_id = beat.get("id")
+        beat_id = beat.id
         if reserved_beat_id != beat_id:
             # L'utente ha una prenotazione per un beat diverso - blocca immediatamente
             await query.message.reply_text(
@@ -869,7 +1057,7 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return BEAT_SELECTION
 
     # Controllo prezzo
-    if not beat.get("price") or beat["price"] <= 0:
+    if not beat.price or beat.price <= 0:
         await query.message.reply_text(
             "❌ Questo beat non è acquistabile perché non ha un prezzo impostato. Contatta l'amministratore."
         )
@@ -877,8 +1065,8 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return BEAT_SELECTION
 
     # Se il beat è esclusivo, gestisci la prenotazione
-    if beat.get("is_exclusive") == 1:
-        beat_id = beat.get("id")
+    if beat.is_exclusive == 1:
+        beat_id = beat.id
         if not beat_id:
             await query.message.reply_text(
                 "❌ Errore interno: ID beat non trovato. Contatta l'amministratore."
@@ -889,7 +1077,7 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Il controllo prenotazione attiva è già stato fatto all'inizio della funzione
 
         # Verifica se il beat è disponibile con motivo dettagliato
-        is_available, reason = get_beat_availability_status(beat_id)
+        is_available, reason = await asyncio.to_thread(get_beat_availability_status, beat_id)
         if not is_available:
             # Personalizza il messaggio in base al motivo
             if "bundle" in reason.lower():
@@ -931,10 +1119,10 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return BEAT_SELECTION
 
         # Tenta di prenotare il beat (prenotazione di 10 minuti)
-        if not reserve_exclusive_beat(beat_id, user_id, reservation_minutes=10):
+        if not await asyncio.to_thread(reserve_exclusive_beat, beat_id, user_id, reservation_minutes=10):
             # La prenotazione è fallita - potrebbe essere per vari motivi
             # Ricontrolla lo stato per fornire feedback preciso
-            has_reservation_now, reservation_info_now, _ = get_user_active_reservation(user_id)
+            has_reservation_now, reservation_info_now, _ = await asyncio.to_thread(get_user_active_reservation, user_id)
             if has_reservation_now:
                 # L'utente ha già una prenotazione (race condition)
                 warning_msg = await query.message.reply_text(
@@ -947,7 +1135,7 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 context.user_data["warning_message_id"].append(warning_msg.message_id)
             else:
                 # Il beat è stato prenotato da qualcun altro nel frattempo
-                _, reason = get_beat_availability_status(beat_id)
+                _, reason = await asyncio.to_thread(get_beat_availability_status, beat_id)
                 warning_msg = await query.message.reply_text(
                     "❌ <b>Prenotazione fallita!</b>\n\n"
                     f"⚡ Un altro utente ha appena prenotato questo beat mentre stavi per acquistarlo.\n\n"
@@ -981,15 +1169,15 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Genera un token di validazione basato su user_id, beat_id e timestamp
     timestamp = int(time.time())
-    token_data = f"{user_id}_{beat['id']}_{timestamp}"
+    token_data = f"{user_id}_{beat.id}_{timestamp}"
     validation_token = hashlib.md5(token_data.encode()).hexdigest()[:16]
     
     checkout_url = (
         f"https://prodbypegasus.pages.dev/checkout"
         f"?user_id={user_id}"
-        f"&beat={quote(beat['title'])}"
-        f"&beat_id={beat['id']}"
-        f"&price={beat['price']:.2f}"
+        f"&beat={quote(beat.title)}"
+        f"&beat_id={beat.id}"
+        f"&price={beat.price:.2f}"
         f"&token={validation_token}"
         f"&timestamp={timestamp}"
     )
@@ -1000,7 +1188,7 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ])
 
     payment_message = await query.message.reply_text(
-        f"{reservation_msg}🎉 Per acquistare <b>{beat['title']}</b>, clicca sul pulsante qui sotto e completa il pagamento.\n\n"
+        f"{reservation_msg}🎉 Per acquistare <b>{beat.title}</b>, clicca sul pulsante qui sotto e completa il pagamento.\n\n"
         "Ti invierò il beat appena ricevo la conferma del pagamento.\n\n"
         "📞 Per assistenza utilizza il pulsante \"Contattaci\".",
         reply_markup=keyboard,
@@ -1014,9 +1202,37 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return BEAT_SELECTION
 
 
-# Rate limit config
-MAX_INVALID_MSGS = 10         # Quanti messaggi errati prima del blocco temporaneo
-BLOCK_DURATION_SEC = 60    # 1 minuti di blocco (puoi aumentare)
+async def _count_invalid_message(context, user_id):
+    """
+    Conta un messaggio non valido e restituisce (contatore, secondi di blocco residui).
+    Con Redis: INCR + EXPIRE sulla finestra di BLOCK_DURATION_SEC e TTL del blocco in un solo round trip.
+    """
+    redis = get_redis()
+    if redis is not None and user_id is not None:
+        try:
+            pipe = redis.pipeline()
+            pipe.incr(f"ri:{user_id}")
+            pipe.expire(f"ri:{user_id}", BLOCK_DURATION_SEC)
+            pipe.ttl(f"b:{user_id}")
+            count, _, blocked_ttl = await pipe.execute()
+            return count, max(blocked_ttl, 0)
+        except Exception as e:
+            logger.warning("Redis non disponibile per il rate-limit, uso lo stato locale: %s", e)
+    context.user_data["invalid_msg_count"] += 1
+    return context.user_data["invalid_msg_count"], 0
+
+async def _block_user(user_id):
+    """Registra il blocco in Redis (se disponibile) e azzera il contatore condiviso"""
+    redis = get_redis()
+    if redis is None or user_id is None:
+        return
+    try:
+        pipe = redis.pipeline()
+        pipe.set(f"b:{user_id}", 1, ex=BLOCK_DURATION_SEC)
+        pipe.delete(f"ri:{user_id}")
+        await pipe.execute()
+    except Exception as e:
+        logger.warning("Errore registrazione blocco su Redis: %s", e)
 
 async def handle_wrong_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Gestisce input non validi: rate-limiting anti-spam, ignora richieste durante il blocco"""
@@ -1041,13 +1257,18 @@ async def handle_wrong_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         except Exception as e:
             logger.debug(f"Errore cancellazione messaggio non valido: {e}")
 
-    # Incrementa il contatore di messaggi errati
-    context.user_data["invalid_msg_count"] += 1
+    # Incrementa il contatore di messaggi errati (in Redis se disponibile, altrimenti in user_data)
+    invalid_count, blocked_ttl = await _count_invalid_message(context, user_id)
+    if blocked_ttl > 0:
+        # Blocco già attivo (impostato da un'altra istanza): allinea lo stato locale
+        context.user_data["blocked_until"] = now + blocked_ttl
+        return context.user_data.get("current_state", GENRE)
 
     # Se supera la soglia, blocca temporaneamente l'utente e avvisa una sola volta
-    if context.user_data["invalid_msg_count"] >= MAX_INVALID_MSGS:
+    if invalid_count >= MAX_INVALID_MSGS:
         context.user_data["blocked_until"] = now + BLOCK_DURATION_SEC
         context.user_data["invalid_msg_count"] = 0
+        await _block_user(user_id)
         chat = update.effective_chat
         if chat:
             try:
@@ -1070,13 +1291,12 @@ async def show_filters_keyboard(update, context):
     user_id = update.effective_user.id
     
     # ⚡ CLEANUP AUTOMATICO: Se l'utente accede ai filtri, cancella prenotazioni precedenti
-    cleanup_expired_reservations()
-    has_reservation, reservation_info, reserved_beat_id = get_user_active_reservation(user_id)
+    has_reservation, reservation_info, reserved_beat_id = await asyncio.to_thread(_active_reservation, user_id)
     
     if has_reservation:
         # Rilascia automaticamente la prenotazione quando si accede ai filtri
-        release_beat_reservation(reserved_beat_id, user_id)
-        print(f"DEBUG: Prenotazione {reserved_beat_id} cancellata durante accesso filtri")
+        await asyncio.to_thread(release_beat_reservation, reserved_beat_id, user_id)
+        logger.debug("Prenotazione %s cancellata durante accesso filtri", reserved_beat_id)
         
         # Cancella il messaggio di pagamento se esiste
         previous_payment_msg_id = context.user_data.get("payment_message_id")
@@ -1102,6 +1322,90 @@ async def show_filters_keyboard(update, context):
     # Non fare query.answer() qui perché viene già fatto in handle_beat_navigation
     await show_main_filter_panel(query, context)
 
+async def _answer_callback(query):
+    """Risponde al callback ignorando le query ormai scadute (la risposta serve solo a chiudere lo spinner)"""
+    try:
+        await query.answer()
+    except BadRequest as e:
+        logger.debug("Callback non più rispondibile: %s", e)
+
+# Chiave nei filtri temporanei per ogni tipo di filtro nei callback ("select_genre_Trap", "remove_mood", ...)
+_FILTER_FIELDS = {"genre": "genre", "mood": "mood", "price": "price_range"}
+
+async def _open_filter_panel(update, context, arg):
+    """filter_<tipo>: apre il pannello di selezione del filtro"""
+    panel = _FILTER_PANELS.get(arg)
+    if panel is not None:
+        await panel(update.callback_query, context)
+    return BEAT_SELECTION
+
+async def _select_filter(update, context, arg):
+    """select_<tipo>_<valore>: imposta il filtro temporaneo e torna al pannello principale"""
+    kind, _, value = arg.partition("_")
+    field = _FILTER_FIELDS.get(kind)
+    if field is not None:
+        context.user_data["temp_filters"][field] = value
+        await show_main_filter_panel(update.callback_query, context)
+    return BEAT_SELECTION
+
+async def _remove_filter(update, context, arg):
+    """remove_<tipo>: azzera il filtro temporaneo e torna al pannello principale"""
+    field = _FILTER_FIELDS.get(arg)
+    if field is not None:
+        context.user_data["temp_filters"][field] = None
+        await show_main_filter_panel(update.callback_query, context)
+    return BEAT_SELECTION
+
+async def _back_to_filters(update, context, arg):
+    # ⚡ CLEANUP: Rilascia prenotazioni quando si naviga tra i pannelli filtri
+    user_id = update.effective_user.id
+    await cleanup_user_reservation_and_payment(user_id, context, update.effective_chat.id, "navigazione pannelli filtri")
+
+    await show_main_filter_panel(update.callback_query, context)
+    return BEAT_SELECTION
+
+async def _apply_filters(update, context, arg):
+    # Il cleanup di prenotazioni e messaggi lo esegue già show_filtered_catalog:
+    # ripeterlo qui raddoppiava le query per ogni applicazione dei filtri
+
+    # Applica i filtri temporanei ai filtri effettivi
+    temp_filters = context.user_data.get("temp_filters", {})
+
+    context.user_data["genre"] = temp_filters.get("genre")
+    context.user_data["mood"] = temp_filters.get("mood")
+    context.user_data["price_range"] = temp_filters.get("price_range")
+
+    # Pulisci i filtri temporanei
+    context.user_data.pop("temp_filters", None)
+
+    # Mostra il catalogo filtrato
+    await show_filtered_catalog(update, context)
+    return BEAT_SELECTION
+
+async def _cancel_filters(update, context, arg):
+    # ⚡ CLEANUP: Rilascia prenotazioni quando si cancellano i filtri
+    user_id = update.effective_user.id
+    await cleanup_user_reservation_and_payment(user_id, context, update.effective_chat.id, "cancellazione filtri")
+
+    # Cancella i filtri temporanei e torna al catalogo
+    context.user_data.pop("temp_filters", None)
+    await show_beat_catalog(update, context)
+    return BEAT_SELECTION
+
+# Routing del pannello filtri: prima il callback esatto, poi il prefisso prima del primo "_"
+_FILTER_EXACT_ROUTES = {
+    "back_to_filters": _back_to_filters,
+    "apply_filters": _apply_filters,
+    "cancel_filters": _cancel_filters,
+}
+# Callback che aprono il catalogo (show_beat_catalog / catalogo vuoto rispondono al callback)
+_FILTER_CATALOG_KEYS = frozenset({"apply_filters", "cancel_filters"})
+_FILTER_PREFIX_ROUTES = {
+    "filter": _open_filter_panel,
+    "select": _select_filter,
+    "remove": _remove_filter,
+}
+
 async def handle_filter_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Gestisce tutte le interazioni del pannello filtri unificato"""
     query = update.callback_query
@@ -1112,96 +1416,118 @@ async def handle_filter_selection(update: Update, context: ContextTypes.DEFAULT_
         await query.answer("🚫 Al momento non ci sono beat disponibili per questa categoria.", show_alert=True)
         return BEAT_SELECTION
 
-    await query.answer()
-
-    # --- NAVIGAZIONE PANNELLI FILTRI ---
-    if data == "filter_genre":
-        await show_genre_selection(query, context)
-        return BEAT_SELECTION
-    
-    if data == "filter_mood":
-        await show_mood_selection(query, context)
-        return BEAT_SELECTION
-    
-    if data == "filter_price":
-        await show_price_selection(query, context)
-        return BEAT_SELECTION
-    
-    if data == "back_to_filters":
-        # ⚡ CLEANUP: Rilascia prenotazioni quando si naviga tra i pannelli filtri
-        user_id = update.effective_user.id
-        await cleanup_user_reservation_and_payment(user_id, context, update.effective_chat.id, "navigazione pannelli filtri")
-        
-        await show_main_filter_panel(query, context)
+    handler = _FILTER_EXACT_ROUTES.get(data)
+    arg = ""
+    if handler is None:
+        prefix, _, arg = data.partition("_")
+        handler = _FILTER_PREFIX_ROUTES.get(prefix)
+    if handler is None:
+        await query.answer()
         return BEAT_SELECTION
 
-    # --- SELEZIONE GENERI ---
-    if data.startswith("select_genre_"):
-        genre = data.replace("select_genre_", "")
-        context.user_data["temp_filters"]["genre"] = genre
-        await show_main_filter_panel(query, context)
-        return BEAT_SELECTION
-    
-    if data == "remove_genre":
-        context.user_data["temp_filters"]["genre"] = None
-        await show_main_filter_panel(query, context)
-        return BEAT_SELECTION
+    if data in _FILTER_CATALOG_KEYS:
+        # Il catalogo risponde da sé al callback: un solo responsabile della risposta
+        return await handler(update, context, arg)
+
+    # Risposta al callback in parallelo al lavoro del pannello (cache/DB):
+    # lo spinner di Telegram sparisce senza attendere il database
+    _, state = await asyncio.gather(_answer_callback(query), handler(update, context, arg))
+    return state
+
+# Bottoni fissi dei pannelli filtri, creati una sola volta all'import
+FILTER_PANEL_ROWS = (
+    (
+        InlineKeyboardButton("🎼 Genere", callback_data="filter_genre"),
+        InlineKeyboardButton("🎚️ Mood", callback_data="filter_mood")
+    ),
+    (InlineKeyboardButton("💰 Prezzo", callback_data="filter_price"),),
+)
+APPLY_FILTERS_ROW = (InlineKeyboardButton("✅ Applica filtri", callback_data="apply_filters"),)
+CANCEL_FILTERS_ROW = (InlineKeyboardButton("❌ Annulla", callback_data="cancel_filters"),)
+FILTER_PANEL_MARKUP = InlineKeyboardMarkup([*FILTER_PANEL_ROWS, CANCEL_FILTERS_ROW])
+FILTER_PANEL_APPLY_MARKUP = InlineKeyboardMarkup([*FILTER_PANEL_ROWS, APPLY_FILTERS_ROW, CANCEL_FILTERS_ROW])
+BACK_TO_FILTERS_ROW = (InlineKeyboardButton("⬅️ Indietro", callback_data="back_to_filters"),)
+REMOVE_GENRE_ROW = (InlineKeyboardButton("🗑️ Rimuovi filtro genere", callback_data="remove_genre"),)
+REMOVE_MOOD_ROW = (InlineKeyboardButton("🗑️ Rimuovi filtro mood", callback_data="remove_mood"),)
+REMOVE_PRICE_ROW = (InlineKeyboardButton("🗑️ Rimuovi filtro prezzo", callback_data="remove_price"),)
+
+# Valori mostrati nei pannelli di selezione, riga per riga
+GENRE_ROWS = (
+    ("Trap", "Hip-Hop"),
+    ("Drill", "R&B"),
+    ("Raggeton", "Brazilian Funk"),
+)
+MOOD_ROWS = (
+    ("Love", "Sad"),
+    ("Hard", "Dark"),
+    ("Chill", "Epic"),
+    ("Happy", "Hype"),
+    ("Emotional",),
+)
+PRICE_ROWS = (
+    ("0-10€", "10-20€"),
+    ("20-30€", "30€+"),
+    ("Tutti",),
+)
 
-    # --- SELEZIONE MOOD ---
-    if data.startswith("select_mood_"):
-        mood = data.replace("select_mood_", "")
-        context.user_data["temp_filters"]["mood"] = mood
-        await show_main_filter_panel(query, context)
-        return BEAT_SELECTION
-    
-    if data == "remove_mood":
-        context.user_data["temp_filters"]["mood"] = None
-        await show_main_filter_panel(query, context)
-        return BEAT_SELECTION
+def _selection_buttons(kind, rows):
+    """Per ogni valore: (bottone normale, bottone selezionato, bottone disabilitato)"""
+    return {
+        value: (
+            InlineKeyboardButton(value, callback_data=f"select_{kind}_{value}"),
+            InlineKeyboardButton(f"✅ {value}", callback_data=f"select_{kind}_{value}"),
+            InlineKeyboardButton(f"🚫 {value}", callback_data=f"disabled_{kind}_{value}"),
+        )
+        for row in rows
+        for value in row
+    }
 
-    # --- SELEZIONE PREZZO ---
-    if data.startswith("select_price_"):
-        price = data.replace("select_price_", "")
-        context.user_data["temp_filters"]["price_range"] = price
-        await show_main_filter_panel(query, context)
-        return BEAT_SELECTION
-    
-    if data == "remove_price":
-        context.user_data["temp_filters"]["price_range"] = None
-        await show_main_filter_panel(query, context)
-        return BEAT_SELECTION
+GENRE_BUTTONS = _selection_buttons("genre", GENRE_ROWS)
+MOOD_BUTTONS = _selection_buttons("mood", MOOD_ROWS)
+PRICE_BUTTONS = _selection_buttons("price", PRICE_ROWS)
 
-    # --- APPLICAZIONE E CANCELLAZIONE FILTRI ---
-    if data == "apply_filters":
-        # ⚡ CLEANUP: Rilascia prenotazioni quando si applicano nuovi filtri
-        user_id = update.effective_user.id
-        await cleanup_user_reservation_and_payment(user_id, context, update.effective_chat.id, "applicazione filtri")
-        
-        # Applica i filtri temporanei ai filtri effettivi
-        temp_filters = context.user_data.get("temp_filters", {})
-        
-        context.user_data["genre"] = temp_filters.get("genre")
-        context.user_data["mood"] = temp_filters.get("mood")
-        context.user_data["price_range"] = temp_filters.get("price_range")
-        
-        # Pulisci i filtri temporanei
-        context.user_data.pop("temp_filters", None)
-        
-        # Mostra il catalogo filtrato
-        await show_filtered_catalog(update, context)
-        return BEAT_SELECTION
-    
-    if data == "cancel_filters":
-        # ⚡ CLEANUP: Rilascia prenotazioni quando si cancellano i filtri
-        user_id = update.effective_user.id
-        await cleanup_user_reservation_and_payment(user_id, context, update.effective_chat.id, "cancellazione filtri")
-        
-        # Cancella i filtri temporanei e torna al catalogo
-        context.user_data.pop("temp_filters", None)
-        await show_beat_catalog(update, context)
-        return BEAT_SELECTION
+def _selection_keyboard(rows, buttons, available, current):
+    """Righe di bottoni del pannello: disabilitati se non disponibili, ✅ sul valore corrente"""
+    return [
+        [
+            buttons[v][1 if v == current else 0] if v in available else buttons[v][2]
+            for v in row
+        ]
+        for row in rows
+    ]
 
-    return BEAT_SELECTION
+# Per ogni pannello: (righe di valori, bottoni, riga "Rimuovi filtro")
+_SELECTION_PANELS = {
+    "genre": (GENRE_ROWS, GENRE_BUTTONS, REMOVE_GENRE_ROW),
+    "mood": (MOOD_ROWS, MOOD_BUTTONS, REMOVE_MOOD_ROW),
+    "price": (PRICE_ROWS, PRICE_BUTTONS, REMOVE_PRICE_ROW),
+}
+
+@lru_cache(maxsize=256)
+def _selection_markup(kind, available, current):
+    """Markup completo di un pannello di selezione, riusato finché disponibilità e selezione non cambiano"""
+    rows, buttons, remove_row = _SELECTION_PANELS[kind]
+    keyboard = _selection_keyboard(rows, buttons, available, current)
+    # Opzione per rimuovere il filtro ("Tutti" equivale a nessun filtro)
+    if current and current != "Tutti":
+        keyboard.append(remove_row)
+    keyboard.append(BACK_TO_FILTERS_ROW)
+    return InlineKeyboardMarkup(keyboard)
+
+def _filter_panel_unchanged(query, context, message_text, reply_markup):
+    """
+    True se il messaggio mostra già esattamente questo pannello: l'edit sarebbe un no-op
+    (Telegram risponderebbe "Message is not modified" e scatterebbe il fallback delete+send).
+    """
+    message = query.message
+    return (
+        context.user_data.get("last_filter_panel") == (message.message_id, message_text)
+        and message.reply_markup == reply_markup
+    )
+
+def _remember_filter_panel(context, message_id, message_text):
+    """Registra il pannello filtri appena mostrato nel messaggio indicato"""
+    context.user_data["last_filter_panel"] = (message_id, message_text)
 
 async def show_main_filter_panel(query, context):
     """Mostra il pannello principale dei filtri con le selezioni correnti"""
@@ -1236,21 +1562,11 @@ async def show_main_filter_panel(query, context):
     # Controlla se almeno un filtro è selezionato per abilitare "Applica filtri"
     has_filters = any(temp_filters.get(k) for k in ["genre", "mood", "price_range"] if temp_filters.get(k) != "Tutti")
     
-    keyboard = [
-        [
-            InlineKeyboardButton("🎼 Genere", callback_data="filter_genre"),
-            InlineKeyboardButton("🎚️ Mood", callback_data="filter_mood")
-        ],
-        [InlineKeyboardButton("💰 Prezzo", callback_data="filter_price")],
-    ]
-    
-    # Aggiungi bottone "Applica filtri" solo se ci sono filtri selezionati
-    if has_filters:
-        keyboard.append([InlineKeyboardButton("✅ Applica filtri", callback_data="apply_filters")])
+    # Bottone "Applica filtri" solo se ci sono filtri selezionati
+    reply_markup = FILTER_PANEL_APPLY_MARKUP if has_filters else FILTER_PANEL_MARKUP
     
-    keyboard.append([InlineKeyboardButton("❌ Annulla", callback_data="cancel_filters")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if _filter_panel_unchanged(query, context, message_text, reply_markup):
+        return  # Il messaggio mostra già questo pannello: niente chiamata API
     
     try:
         # Se il messaggio ha una foto, usa edit_message_media per sostituirla con testo
@@ -1264,6 +1580,7 @@ async def show_main_filter_panel(query, context):
             )
             # Aggiorna l'ID del messaggio nel context per future modifiche
             context.user_data["last_bot_message_id"] = sent.message_id
+            _remember_filter_panel(context, sent.message_id, message_text)
         else:
             # Se è già un messaggio di testo, editalo normalmente
             await query.edit_message_text(
@@ -1271,6 +1588,7 @@ async def show_main_filter_panel(query, context):
                 reply_markup=reply_markup,
                 parse_mode='HTML'
             )
+            _remember_filter_panel(context, query.message.message_id, message_text)
     except Exception as e:
         logger.error(f"Errore aggiornamento pannello filtri: {e}")
         # Fallback: cancella e ricrea il messaggio
@@ -1285,77 +1603,145 @@ async def show_main_filter_panel(query, context):
                 parse_mode='HTML'
             )
             context.user_data["last_bot_message_id"] = sent.message_id
+            _remember_filter_panel(context, sent.message_id, message_text)
         except Exception as fallback_error:
             logger.error(f"Errore fallback pannello filtri: {fallback_error}")
 
+# Fascia di prezzo calcolata in SQL, con gli stessi confini di PRICE_RANGES
+_PRICE_BUCKET = case(
+    (Beat.price < 0, null()),
+    (Beat.price <= 10, "0-10€"),
+    (Beat.price <= 20, "10-20€"),
+    (Beat.price <= 30, "20-30€"),
+    else_="30€+",
+).label("bucket")
+
+def _query_filter_rows(category):
+    """Combinazioni distinte (genere, mood, fascia di prezzo) della categoria, in un'unica query (sincrona: in un thread)"""
+    # Le categorie sconosciute valgono come standard
+    cond = _CATEGORY_CONDS.get(category, _CATEGORY_CONDS["standard"])
+    stmt = select(Beat.genre, Beat.mood, _PRICE_BUCKET).where(cond).distinct()
+    with SessionLocal() as session:
+        return [tuple(row) for row in session.execute(stmt)]
+
+# Combinazioni per categoria: poche chiavi, cambiano solo quando cambiano i beat
+FILTER_CACHE_TTL = 30
+_filter_rows_cache = TTLCache(maxsize=8, ttl=FILTER_CACHE_TTL)
+# Un lock per categoria: un miss lento (DB o Redis) non blocca i pannelli delle altre categorie
+_filter_rows_locks = {category: asyncio.Lock() for category in _CATEGORY_CONDS}
+
+def _shared_filter_key(category):
+    return f"filters:{category}"
+
+async def _read_shared_filter_rows(redis, category):
+    """Combinazioni salvate in Redis da un'altra istanza del bot, None se assenti o Redis non risponde"""
+    try:
+        blob = await redis.get(_shared_filter_key(category))
+    except Exception as e:
+        logger.warning("Redis non disponibile per i filtri, uso il database: %s", e)
+        return None
+    if blob is None:
+        return None
+    try:
+        return [tuple(row) for row in orjson.loads(blob)]
+    except (orjson.JSONDecodeError, TypeError) as e:
+        # Valore illeggibile: trattato come assente, verrà riscritto dopo la query
+        logger.warning("Combinazioni filtri non valide in Redis, uso il database: %s", e)
+        return None
+
+async def _write_shared_filter_rows(redis, category, rows):
+    """Condivide le combinazioni con le altre istanze per FILTER_CACHE_TTL secondi"""
+    try:
+        await redis.set(_shared_filter_key(category), orjson.dumps(rows), ex=FILTER_CACHE_TTL)
+    except Exception as e:
+        logger.warning("Errore salvataggio filtri su Redis: %s", e)
+
+def _drop_shared_filter_rows():
+    """Elimina le combinazioni condivise in Redis senza attendere (chiamata da codice sincrono)"""
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        task = asyncio.get_running_loop().create_task(
+            redis.delete(*(_shared_filter_key(category) for category in _CATEGORY_CONDS))
+        )
+    except RuntimeError:
+        return  # Nessun event loop attivo: le chiavi scadono comunque entro FILTER_CACHE_TTL
+    _background_deletes.add(task)
+
+    def _done(t):
+        _background_deletes.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            logger.debug("Errore invalidazione filtri su Redis: %s", t.exception())
+
+    task.add_done_callback(_done)
+
+async def _get_filter_rows(category):
+    """
+    Combinazioni della categoria: cache locale, poi Redis (condivisa tra le istanze, se configurato),
+    infine il database. Al miss una sola query anche con click concorrenti.
+    """
+    if category not in _CATEGORY_CONDS:
+        category = "standard"
+    rows = _filter_rows_cache.get(category)
+    if rows is not None:
+        return rows
+    async with _filter_rows_locks[category]:
+        rows = _filter_rows_cache.get(category)
+        if rows is None:
+            redis = get_redis()
+            if redis is not None:
+                rows = await _read_shared_filter_rows(redis, category)
+            if rows is None:
+                rows = await asyncio.to_thread(_query_filter_rows, category)
+                if redis is not None:
+                    await _write_shared_filter_rows(redis, category, rows)
+            _filter_rows_cache[category] = rows
+    return rows
+
+async def get_filter_availability(category, temp_filters):
+    """
+    Restituisce (generi, mood, fasce di prezzo) disponibili per i pannelli filtri.
+    Ogni insieme tiene conto degli altri filtri già selezionati, come facevano le query separate.
+    """
+    rows = await _get_filter_rows(category)
+
+    genre = temp_filters.get("genre")
+    mood = temp_filters.get("mood")
+    price_range = temp_filters.get("price_range")
+    if price_range == "Tutti":
+        price_range = None
+
+    available_genres = frozenset(g for g, m, b in rows if (not mood or m == mood) and (not price_range or b == price_range))
+    available_moods = frozenset(m for g, m, b in rows if (not genre or g == genre) and (not price_range or b == price_range))
+    buckets = [b for g, m, b in rows if (not genre or g == genre) and (not mood or m == mood)]
+    available_prices = frozenset(b for b in buckets if b is not None)
+    if buckets:
+        available_prices |= {"Tutti"}
+    return available_genres, available_moods, available_prices
+
 async def show_genre_selection(query, context):
     """Mostra la selezione dei generi disponibili"""
     category = context.user_data.get("catalog_category", "standard")
     temp_filters = context.user_data.get("temp_filters", {})
     
     # Calcola generi disponibili considerando i filtri già selezionati
-    with SessionLocal() as session:
-        q = session.query(Beat.genre).distinct()
-        
-        # Applica filtro categoria
-        if category == "exclusive":
-            q = q.filter(Beat.is_exclusive == 1)
-        elif category == "discount":
-            q = q.filter(Beat.is_discounted == 1)
-        else:
-            q = q.filter(Beat.is_exclusive == 0)
-        
-        # Applica filtri esistenti
-        if temp_filters.get("mood"):
-            q = q.filter(Beat.mood == temp_filters["mood"])
-        if temp_filters.get("price_range") and temp_filters["price_range"] != "Tutti":
-            price_range = temp_filters["price_range"]
-            if price_range == "0-10€":
-                q = q.filter(Beat.price >= 0, Beat.price <= 10)
-            elif price_range == "10-20€":
-                q = q.filter(Beat.price > 10, Beat.price <= 20)
-            elif price_range == "20-30€":
-                q = q.filter(Beat.price > 20, Beat.price <= 30)
-            elif price_range == "30€+":
-                q = q.filter(Beat.price > 30)
-        
-        available_genres = set(g for (g,) in q)
+    available_genres, _, _ = await get_filter_availability(category, temp_filters)
 
-    # Lista dei generi da mostrare
-    genres = [
-        ("Trap", "Hip-Hop"),
-        ("Drill", "R&B"),
-        ("Raggeton", "Brazilian Funk"),
-    ]
-    
-    keyboard = []
-    for g1, g2 in genres:
-        row = []
-        for g in (g1, g2):
-            if g in available_genres:
-                # Segna il genere come selezionato se è quello corrente
-                if temp_filters.get("genre") == g:
-                    row.append(InlineKeyboardButton(f"✅ {g}", callback_data=f"select_genre_{g}"))
-                else:
-                    row.append(InlineKeyboardButton(g, callback_data=f"select_genre_{g}"))
-            else:
-                row.append(InlineKeyboardButton(f"🚫 {g}", callback_data=f"disabled_genre_{g}"))
-        keyboard.append(row)
-    
-    # Opzione per rimuovere il filtro genere
-    if temp_filters.get("genre"):
-        keyboard.append([InlineKeyboardButton("🗑️ Rimuovi filtro genere", callback_data="remove_genre")])
-    
-    keyboard.append([InlineKeyboardButton("⬅️ Indietro", callback_data="back_to_filters")])
+    reply_markup = _selection_markup("genre", available_genres, temp_filters.get("genre"))
     
     message_text = "🎼 <b>Seleziona un genere:</b>\n\nScegli il tipo di sonorità che preferisci per il tuo beat."
     
+    if _filter_panel_unchanged(query, context, message_text, reply_markup):
+        return  # Il messaggio mostra già questo pannello: niente chiamata API
+
     try:
         await query.edit_message_text(
             message_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=reply_markup,
             parse_mode='HTML'
         )
+        _remember_filter_panel(context, query.message.message_id, message_text)
     except Exception as e:
         logger.error(f"Errore selezione genere: {e}")
         # Fallback: ricrea il messaggio
@@ -1363,10 +1749,11 @@ async def show_genre_selection(query, context):
             await query.message.delete()
             sent = await query.message.chat.send_message(
                 message_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=reply_markup,
                 parse_mode='HTML'
             )
             context.user_data["last_bot_message_id"] = sent.message_id
+            _remember_filter_panel(context, sent.message_id, message_text)
         except Exception as fallback_error:
             logger.error(f"Errore fallback selezione genere: {fallback_error}")
 
@@ -1376,70 +1763,22 @@ async def show_mood_selection(query, context):
     temp_filters = context.user_data.get("temp_filters", {})
     
     # Calcola mood disponibili considerando i filtri già selezionati
-    with SessionLocal() as session:
-        q = session.query(Beat.mood).distinct()
-        
-        # Applica filtro categoria
-        if category == "exclusive":
-            q = q.filter(Beat.is_exclusive == 1)
-        elif category == "discount":
-            q = q.filter(Beat.is_discounted == 1)
-        else:
-            q = q.filter(Beat.is_exclusive == 0)
-        
-        # Applica filtri esistenti
-        if temp_filters.get("genre"):
-            q = q.filter(Beat.genre == temp_filters["genre"])
-        if temp_filters.get("price_range") and temp_filters["price_range"] != "Tutti":
-            price_range = temp_filters["price_range"]
-            if price_range == "0-10€":
-                q = q.filter(Beat.price >= 0, Beat.price <= 10)
-            elif price_range == "10-20€":
-                q = q.filter(Beat.price > 10, Beat.price <= 20)
-            elif price_range == "20-30€":
-                q = q.filter(Beat.price > 20, Beat.price <= 30)
-            elif price_range == "30€+":
-                q = q.filter(Beat.price > 30)
-        
-        available_moods = set(m for (m,) in q)
-
-    # Lista dei mood da mostrare
-    moods = [
-        ("Love", "Sad"),
-        ("Hard", "Dark"),
-        ("Chill", "Epic"),
-        ("Happy", "Hype"),
-        ("Emotional",),
-    ]
-    
-    keyboard = []
-    for row in moods:
-        mood_row = []
-        for m in row:
-            if m in available_moods:
-                # Segna il mood come selezionato se è quello corrente
-                if temp_filters.get("mood") == m:
-                    mood_row.append(InlineKeyboardButton(f"✅ {m}", callback_data=f"select_mood_{m}"))
-                else:
-                    mood_row.append(InlineKeyboardButton(m, callback_data=f"select_mood_{m}"))
-            else:
-                mood_row.append(InlineKeyboardButton(f"🚫 {m}", callback_data=f"disabled_mood_{m}"))
-        keyboard.append(mood_row)
-    
-    # Opzione per rimuovere il filtro mood
-    if temp_filters.get("mood"):
-        keyboard.append([InlineKeyboardButton("🗑️ Rimuovi filtro mood", callback_data="remove_mood")])
-    
-    keyboard.append([InlineKeyboardButton("⬅️ Indietro", callback_data="back_to_filters")])
+    _, available_moods, _ = await get_filter_availability(category, temp_filters)
+
+    reply_markup = _selection_markup("mood", available_moods, temp_filters.get("mood"))
     
     message_text = "🎚️ <b>Seleziona un mood:</b>\n\nScegli l'atmosfera che vuoi evocare con il tuo beat."
     
+    if _filter_panel_unchanged(query, context, message_text, reply_markup):
+        return  # Il messaggio mostra già questo pannello: niente chiamata API
+
     try:
         await query.edit_message_text(
             message_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=reply_markup,
             parse_mode='HTML'
         )
+        _remember_filter_panel(context, query.message.message_id, message_text)
     except Exception as e:
         logger.error(f"Errore selezione mood: {e}")
         # Fallback: ricrea il messaggio
@@ -1447,10 +1786,11 @@ async def show_mood_selection(query, context):
             await query.message.delete()
             sent = await query.message.chat.send_message(
                 message_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=reply_markup,
                 parse_mode='HTML'
             )
             context.user_data["last_bot_message_id"] = sent.message_id
+            _remember_filter_panel(context, sent.message_id, message_text)
         except Exception as fallback_error:
             logger.error(f"Errore fallback selezione mood: {fallback_error}")
 
@@ -1460,68 +1800,22 @@ async def show_price_selection(query, context):
     temp_filters = context.user_data.get("temp_filters", {})
     
     # Calcola fasce di prezzo disponibili considerando i filtri già selezionati
-    with SessionLocal() as session:
-        def price_count(cond):
-            q = session.query(Beat)
-            
-            # Applica filtro categoria
-            if category == "exclusive":
-                q = q.filter(Beat.is_exclusive == 1)
-            elif category == "discount":
-                q = q.filter(Beat.is_discounted == 1)
-            else:
-                q = q.filter(Beat.is_exclusive == 0)
-            
-            # Applica filtri esistenti
-            if temp_filters.get("genre"):
-                q = q.filter(Beat.genre == temp_filters["genre"])
-            if temp_filters.get("mood"):
-                q = q.filter(Beat.mood == temp_filters["mood"])
-                
-            return q.filter(*cond).count() > 0
-
-        prices_available = {
-            "0-10€": price_count([Beat.price >= 0, Beat.price <= 10]),
-            "10-20€": price_count([Beat.price > 10, Beat.price <= 20]),
-            "20-30€": price_count([Beat.price > 20, Beat.price <= 30]),
-            "30€+": price_count([Beat.price > 30]),
-            "Tutti": price_count([]),
-        }
+    _, _, available_prices = await get_filter_availability(category, temp_filters)
     
-    price_rows = [
-        ["0-10€", "10-20€"],
-        ["20-30€", "30€+"],
-        ["Tutti"]
-    ]
-    
-    keyboard = []
-    for row in price_rows:
-        btn_row = []
-        for p in row:
-            if prices_available.get(p, False):
-                # Segna il prezzo come selezionato se è quello corrente
-                if temp_filters.get("price_range") == p:
-                    btn_row.append(InlineKeyboardButton(f"✅ {p}", callback_data=f"select_price_{p}"))
-                else:
-                    btn_row.append(InlineKeyboardButton(p, callback_data=f"select_price_{p}"))
-            else:
-                btn_row.append(InlineKeyboardButton(f"🚫 {p}", callback_data=f"disabled_price_{p}"))
-        keyboard.append(btn_row)
-    
-    # Opzione per rimuovere il filtro prezzo
-    if temp_filters.get("price_range") and temp_filters["price_range"] != "Tutti":
-        keyboard.append([InlineKeyboardButton("🗑️ Rimuovi filtro prezzo", callback_data="remove_price")])
-    
-    keyboard.append([InlineKeyboardButton("⬅️ Indietro", callback_data="back_to_filters")])
+    reply_markup = _selection_markup("price", available_prices, temp_filters.get("price_range"))
     
     message_text = "💰 <b>Seleziona una fascia di prezzo:</b>\n\nImposta il tuo budget per trovare i beat più adatti."
     
+    if _filter_panel_unchanged(query, context, message_text, reply_markup):
+        return  # Il messaggio mostra già questo pannello: niente chiamata API
+
     try:
         await query.edit_message_text(
             message_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=reply_markup,
             parse_mode='HTML'
         )
+        _remember_filter_panel(context, query.message.message_id, message_text)
     except Exception as e:
         logger.error(f"Errore selezione prezzo: {e}")
         # Fallback: ricrea il messaggio
@@ -1529,13 +1823,21 @@ async def show_price_selection(query, context):
             await query.message.delete()
             sent = await query.message.chat.send_message(
                 message_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=reply_markup,
                 parse_mode='HTML'
             )
             context.user_data["last_bot_message_id"] = sent.message_id
+            _remember_filter_panel(context, sent.message_id, message_text)
         except Exception as fallback_error:
             logger.error(f"Errore fallback selezione prezzo: {fallback_error}")
 
+# Pannelli di selezione per filter_<tipo> (definito dopo le funzioni a cui punta)
+_FILTER_PANELS = {
+    "genre": show_genre_selection,
+    "mood": show_mood_selection,
+    "price": show_price_selection,
+}
+
 # ====== FUNZIONI PER GESTIONE BUNDLE ======
 
 async def show_bundles_catalog(update, context):
@@ -1547,7 +1849,7 @@ async def show_bundles_catalog(update, context):
     await cleanup_user_reservation_and_payment(user_id, context, update.effective_chat.id, "accesso sezione bundle")
     
     # Recupera i bundle attivi
-    bundles = get_active_bundles()
+    bundles = await asyncio.to_thread(get_active_bundles)
     
     if not bundles:
         # Nessun bundle disponibile
@@ -1706,7 +2008,7 @@ async def update_message_with_bundle(query, bundle, caption, keyboard):
         # Usa la configurazione centralizzata R2
         image_url = f"{R2_PUBLIC_BASE}/{image_key}"
         
-        if validate_url(image_url):
+        if await validate_url(image_url):
             try:
                 await query.edit_message_media(
                     media=InputMediaPhoto(image_url, caption=caption, parse_mode='HTML'),
@@ -1725,7 +2027,7 @@ async def update_message_with_bundle(query, bundle, caption, keyboard):
         try:
             await query.message.delete()
         except Exception as ex:
-            logger.debug(f"Errore eliminazione messaggio: {ex}")
+            logger.debug("Errore eliminazione messaggio: %s", ex)
         await query.message.chat.send_message(
             caption, reply_markup=reply_markup, parse_mode='HTML'
         )
@@ -1823,7 +2125,7 @@ async def handle_bundle_payment(update, context):
     
     # ⚡ CONTROLLO PRENOTAZIONE UTENTE ATTIVA
     # Prima di tutto, verifica se l'utente ha già una prenotazione attiva
-    has_reservation, reservation_info, _ = get_user_active_reservation(user_id)
+    has_reservation, reservation_info, _ = await asyncio.to_thread(get_user_active_reservation, user_id)
     if has_reservation:
         logger.info(f"❌ User {user_id} already has active reservation: {reservation_info}")
         await query.message.reply_text(
@@ -1846,7 +2148,10 @@ async def handle_bundle_payment(update, context):
     if exclusive_beats_in_bundle:
         # Se ci sono beat esclusivi, prova a prenotare tutto il bundle atomicamente CON RETRY
         logger.info(f"⚡ ATTEMPTING ATOMIC RESERVATION WITH RETRY - User: {user_id}, Bundle: {bundle['id']}")
-        success, message = reserve_bundle_exclusive_beats_with_retry(bundle['id'], user_id, reservation_minutes=10, max_retries=3)
+        # In un thread: oltre alle query, i retry attendono con time.sleep
+        success, message = await asyncio.to_thread(
+            reserve_bundle_exclusive_beats_with_retry, bundle['id'], user_id, reservation_minutes=10, max_retries=3
+        )
         logger.info(f"⚡ RESERVATION RESULT - User: {user_id}, Bundle: {bundle['id']}, Success: {success}, Message: {message}")
         
         if not success:
@@ -5,132 +5,193 @@ Gestisce automaticamente sandbox vs produzione
 """
 
 import os
-from dotenv import load_dotenv
+import sys
+from functools import lru_cache
+from dataclasses import dataclass
+from typing import Optional
 
-# Carica .env se esiste
 env_path = os.path.join(os.path.dirname(__file__), '.env')
-if os.path.exists(env_path):
-    load_dotenv(env_path)
+_DOTENV_LOADED = False
 
-def get_environment():
-    """Determina l'ambiente di esecuzione"""
+def _ensure_dotenv():
+    """Carica .env (se esiste) una sola volta per processo"""
+    global _DOTENV_LOADED
+    if _DOTENV_LOADED:
+        return
+    _DOTENV_LOADED = True
+    # In produzione le variabili arrivano dall'orchestratore: niente stat del file né import di dotenv
+    if os.environ.get("ENVIRONMENT", "").lower() == "production":
+        return
+    if os.path.exists(env_path):
+        # Import locale: senza file .env (es. in produzione) python-dotenv non viene mai caricato
+        from dotenv import load_dotenv
+        # override=False: le variabili già presenti nell'ambiente hanno la precedenza
+        load_dotenv(env_path, override=False)
+
+def _read_environment():
+    """Legge l'ambiente di esecuzione dalle variabili d'ambiente"""
+    _ensure_dotenv()
     env = os.environ.get("ENVIRONMENT", "development").lower()
     return "production" if env == "production" else "development"
 
+# Variabili obbligatorie per ambiente; ogni voce elenca i nomi accettati in ordine di
+# preferenza (gli alias in sviluppo restano per compatibilità)
+_REQUIRED = {
+    "production": {
+        "token": ("PROD_TOKEN_BOT",),
+        "database_url": ("PROD_DATABASE_URL",),
+    },
+    "development": {
+        "token": ("DEV_TOKEN_BOT", "Token_Bot"),
+        "database_url": ("DEV_DATABASE_URL", "DATABASE_URL"),
+    },
+}
+
+def _validate_required(env):
+    """Risolve le variabili obbligatorie una sola volta, segnalando tutte quelle mancanti insieme"""
+    values = {}
+    missing = []
+    for field, names in _REQUIRED[env].items():
+        value = next((v for v in map(os.environ.get, names) if v), None)
+        if value is None:
+            missing.append(" / ".join(names))
+        values[field] = value
+    if missing:
+        raise RuntimeError(
+            f"Variabili d'ambiente mancanti per ambiente di {'produzione' if env == 'production' else 'sviluppo'}: "
+            + ", ".join(missing)
+        )
+    return values
+
+# Ambiente e variabili obbligatorie calcolati una volta all'import: non cambiano durante la vita del processo
+_ENV = _read_environment()
+_REQUIRED_VALUES = _validate_required(_ENV)
+
+def get_environment():
+    """Determina l'ambiente di esecuzione"""
+    return _ENV
+
+@dataclass(slots=True, frozen=True)
+class TelegramConfig:
+    token: str
+    env_name: str
+
+@dataclass(slots=True, frozen=True)
+class PayPalConfig:
+    client_id: Optional[str]
+    client_secret: Optional[str]
+    api_base: str
+    env_name: str
+
+@dataclass(slots=True, frozen=True)
+class R2Config:
+    public_base_url: Optional[str]
+    access_key_id: Optional[str]
+    secret_access_key: Optional[str]
+    endpoint_url: Optional[str]
+    bucket_name: Optional[str]
+
+@dataclass(slots=True, frozen=True)
+class InternalConfig:
+    bot_url: Optional[str]
+    token: Optional[str]
+
+# Sezioni costruite da tabella: (tipo, campi letti da PROD_<VAR>/DEV_<VAR>, valori fissi per ambiente)
+_SECTIONS = {
+    "paypal": (
+        PayPalConfig,
+        (("client_id", "PAYPAL_CLIENT_ID"), ("client_secret", "PAYPAL_CLIENT_SECRET")),
+        {
+            "production": {"api_base": "https://api-m.paypal.com", "env_name": "LIVE 💰"},
+            "development": {"api_base": "https://api-m.sandbox.paypal.com", "env_name": "SANDBOX 🧪"},
+        },
+    ),
+    "r2": (
+        R2Config,
+        (
+            ("public_base_url", "R2_PUBLIC_BASE_URL"),
+            ("access_key_id", "R2_ACCESS_KEY_ID"),
+            ("secret_access_key", "R2_SECRET_ACCESS_KEY"),
+            ("endpoint_url", "R2_ENDPOINT_URL"),
+            ("bucket_name", "R2_BUCKET_NAME"),
+        ),
+        {},
+    ),
+    "internal": (
+        InternalConfig,
+        (("bot_url", "BOT_INTERNAL_URL"), ("token", "INTERNAL_TOKEN")),
+        {},
+    ),
+}
+
+def _build_section(section):
+    """Costruisce una sezione di configurazione scegliendo il prefisso in base all'ambiente"""
+    config_type, fields, fixed = _SECTIONS[section]
+    prefix = "PROD" if _ENV == "production" else "DEV"
+    values = {field: os.environ.get(f"{prefix}_{var}") for field, var in fields}
+    values.update(fixed.get(_ENV, {}))
+    return config_type(**values)
+
+@lru_cache(maxsize=None)
 def get_telegram_config():
     """Ottiene configurazione Telegram basata sull'ambiente"""
-    env = get_environment()
-    
-    if env == "production":
-        token = os.environ.get("PROD_TOKEN_BOT")
-        if not token:
-            raise RuntimeError("PROD_TOKEN_BOT non impostato per ambiente di produzione!")
-        return {
-            "token": token,
-            "env_name": "PRODUCTION 🚀"
-        }
-    else:
-        token = os.environ.get("DEV_TOKEN_BOT")
-        if not token:
-            # Fallback per compatibilità
-            token = os.environ.get("Token_Bot")
-        if not token:
-            raise RuntimeError("DEV_TOKEN_BOT non impostato per ambiente di sviluppo!")
-        return {
-            "token": token,
-            "env_name": "DEVELOPMENT 🧪"
-        }
+    env_name = "PRODUCTION 🚀" if _ENV == "production" else "DEVELOPMENT 🧪"
+    return TelegramConfig(token=_REQUIRED_VALUES["token"], env_name=env_name)
 
+@lru_cache(maxsize=None)
 def get_paypal_config():
     """Ottiene configurazione PayPal basata sull'ambiente"""
-    env = get_environment()
-    
-    if env == "production":
-        return {
-            "client_id": os.environ.get("PROD_PAYPAL_CLIENT_ID"),
-            "client_secret": os.environ.get("PROD_PAYPAL_CLIENT_SECRET"),
-            "api_base": "https://api-m.paypal.com",
-            "env_name": "LIVE 💰"
-        }
-    else:
-        return {
-            "client_id": os.environ.get("DEV_PAYPAL_CLIENT_ID"),
-            "client_secret": os.environ.get("DEV_PAYPAL_CLIENT_SECRET"),
-            "api_base": "https://api-m.sandbox.paypal.com",
-            "env_name": "SANDBOX 🧪"
-        }
+    return _build_section("paypal")
 
+@lru_cache(maxsize=None)
 def get_r2_config():
     """Ottiene configurazione R2 basata sull'ambiente"""
-    env = get_environment()
-    
-    if env == "production":
-        return {
-            "public_base_url": os.environ.get("PROD_R2_PUBLIC_BASE_URL"),
-            "access_key_id": os.environ.get("PROD_R2_ACCESS_KEY_ID"),
-            "secret_access_key": os.environ.get("PROD_R2_SECRET_ACCESS_KEY"),
-            "endpoint_url": os.environ.get("PROD_R2_ENDPOINT_URL"),
-            "bucket_name": os.environ.get("PROD_R2_BUCKET_NAME")
-        }
-    else:
-        return {
-            "public_base_url": os.environ.get("DEV_R2_PUBLIC_BASE_URL"),
-            "access_key_id": os.environ.get("DEV_R2_ACCESS_KEY_ID"),
-            "secret_access_key": os.environ.get("DEV_R2_SECRET_ACCESS_KEY"),
-            "endpoint_url": os.environ.get("DEV_R2_ENDPOINT_URL"),
-            "bucket_name": os.environ.get("DEV_R2_BUCKET_NAME")
-        }
+    return _build_section("r2")
 
+@lru_cache(maxsize=None)
 def get_database_url():
     """Ottiene URL database basato sull'ambiente"""
-    env = get_environment()
-    
-    if env == "production":
-        url = os.environ.get("PROD_DATABASE_URL")
-        if not url:
-            raise RuntimeError("PROD_DATABASE_URL non impostato per ambiente di produzione!")
-        return url
-    else:
-        url = os.environ.get("DEV_DATABASE_URL")
-        if not url:
-            # Fallback per compatibilità
-            url = os.environ.get("DATABASE_URL")
-        if not url:
-            raise RuntimeError("DEV_DATABASE_URL non impostato per ambiente di sviluppo!")
-        return url
+    return _REQUIRED_VALUES["database_url"]
 
+@lru_cache(maxsize=None)
 def get_internal_config():
     """Ottiene configurazione comunicazione interna basata sull'ambiente"""
-    env = get_environment()
-    
-    if env == "production":
-        return {
-            "bot_url": os.environ.get("PROD_BOT_INTERNAL_URL"),
-            "token": os.environ.get("PROD_INTERNAL_TOKEN")
-        }
-    else:
-        return {
-            "bot_url": os.environ.get("DEV_BOT_INTERNAL_URL"),
-            "token": os.environ.get("DEV_INTERNAL_TOKEN")
-        }
-
-def get_env_var(key, default=None):
-    """Ottiene variabile di ambiente (compatibilità)"""
-    return os.environ.get(key, default)
+    return _build_section("internal")
+
+def reset_config_cache():
+    """Svuota la cache dei getter (utile nei test o dopo aver modificato os.environ)"""
+    global _ENV, _REQUIRED_VALUES
+    _ENV = _read_environment()
+    _REQUIRED_VALUES = _validate_required(_ENV)
+    for getter in (
+        get_telegram_config,
+        get_paypal_config,
+        get_r2_config,
+        get_database_url,
+        get_internal_config,
+    ):
+        getter.cache_clear()
+
+# Ottiene variabile di ambiente (compatibilità). Il .env è già caricato all'import da
+# _read_environment(), quindi basta un alias diretto senza frame Python aggiuntivo
+get_env_var = os.environ.get
 
 def print_config_summary():
     """Stampa un riassunto della configurazione attuale"""
-    env = get_environment()
     telegram_config = get_telegram_config()
     paypal_config = get_paypal_config()
     r2_config = get_r2_config()
-    
-    print("🤖 BOT TELEGRAM AVVIATO")
-    print(f"🌍 Ambiente: {telegram_config['env_name']}")
-    print(f"💳 PayPal: {paypal_config['env_name']}")
-    print(f"💾 Database: {get_database_url().split('@')[0]}@***")  # Log sicuro
-    print(f"☁️  R2 Bucket: {r2_config['bucket_name']}")
-    print("=" * 50)
+    db_masked = get_database_url().split("@", 1)[0] + "@***"  # Log sicuro
+
+    # Un'unica scrittura su stdout invece di una print per riga
+    sys.stdout.write(
+        "🤖 BOT TELEGRAM AVVIATO\n"
+        f"🌍 Ambiente: {telegram_config.env_name}\n"
+        f"💳 PayPal: {paypal_config.env_name}\n"
+        f"💾 Database: {db_masked}\n"
+        f"☁️  R2 Bucket: {r2_config.bucket_name}\n"
+        f"{'=' * 50}\n"
+    )
 
 if __name__ == "__main__":
     # Test configurazione
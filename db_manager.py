@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, text, BigInteger
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, text, BigInteger, Index
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
 from sqlalchemy.pool import QueuePool
 from datetime import datetime, timedelta, timezone
@@ -10,7 +10,10 @@ import time
 import random
 
 # Configurazione logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
 logger = logging.getLogger(__name__)
 
 # Usa la configurazione centralizzata
@@ -25,7 +28,8 @@ engine = create_engine(
     pool_size=10,
     max_overflow=5,
     pool_timeout=30,
-    pool_recycle=300
+    pool_recycle=300,
+    pool_pre_ping=True  # Scarta le connessioni cadute prima di usarle invece di fallire la query
 )
 
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
@@ -38,7 +42,7 @@ class Beat(Base):
     genre = Column(String(50), nullable=False)
     mood = Column(String(50), nullable=False)
     folder = Column(String(50), nullable=False)
-    title = Column(String(100), nullable=False)
+    title = Column(String(100), nullable=False, index=True)
     preview_key = Column(String(255), nullable=False)
     file_key = Column(String(255), nullable=False)
     image_key = Column(String(255), nullable=False)
@@ -57,6 +61,11 @@ class Beat(Base):
     orders = relationship("Order", back_populates="beat")
     bundle_beats = relationship("BundleBeat", back_populates="beat")
 
+    # Indice composito per le query del catalogo (categoria + filtri genere/mood/prezzo)
+    __table_args__ = (
+        Index("ix_beat_cat", "is_exclusive", "is_discounted", "genre", "mood", "price"),
+    )
+
 class Order(Base):
     __tablename__ = "orders"
 
@@ -224,6 +233,33 @@ def release_beat_reservation(beat_id: int, user_id: int = None) -> bool:
         session.commit()
         return True
 
+def release_beat_reservations(beat_ids: list[int], user_id: int = None) -> int:
+    """
+    Rilascia con un solo UPDATE le prenotazioni di più beat esclusivi.
+    Se user_id è specificato, rilascia solo i beat prenotati da quell'utente.
+    
+    Returns:
+        int: Numero di prenotazioni rilasciate
+    """
+    if not beat_ids:
+        return 0
+    
+    with SessionLocal() as session:
+        query = session.query(Beat).filter(Beat.id.in_(beat_ids))
+        if user_id is not None:
+            query = query.filter(Beat.reserved_by_user_id == user_id)
+        
+        released_count = query.update(
+            {
+                Beat.reserved_by_user_id: None,
+                Beat.reserved_at: None,
+                Beat.reservation_expires_at: None,
+            },
+            synchronize_session=False
+        )
+        session.commit()
+        return released_count
+
 def cleanup_expired_reservations():
     """
     Pulisce automaticamente le prenotazioni scadute.
@@ -233,25 +269,19 @@ def cleanup_expired_reservations():
     with SessionLocal() as session:
         now = datetime.now()  # Uso datetime naive per consistenza
         
-        # Trova tutte le prenotazioni che potrebbero essere scadute
-        potentially_expired = session.query(Beat).filter(
+        # Un solo UPDATE sulle prenotazioni scadute (confronto tra datetime naive)
+        expired_count = session.query(Beat).filter(
             Beat.reserved_by_user_id.isnot(None),
-            Beat.reservation_expires_at.isnot(None)
-        ).all()
-        
-        expired_count = 0
-        
-        # Controlla ogni prenotazione (ora tutto naive)
-        for beat in potentially_expired:
-            expires_at = beat.reservation_expires_at
-            
-            # Confronto diretto tra datetime naive
-            if expires_at < now:
-                # Prenotazione scaduta
-                beat.reserved_by_user_id = None
-                beat.reserved_at = None
-                beat.reservation_expires_at = None
-                expired_count += 1
+            Beat.reservation_expires_at.isnot(None),
+            Beat.reservation_expires_at < now
+        ).update(
+            {
+                Beat.reserved_by_user_id: None,
+                Beat.reserved_at: None,
+                Beat.reservation_expires_at: None,
+            },
+            synchronize_session=False
+        )
         
         session.commit()
         return expired_count
@@ -403,6 +433,19 @@ def create_bundle_order(bundle_id: int, user_id: int, total_price: float) -> int
         session.commit()
         return order.id
 
+def ensure_beat_indexes():
+    """
+    Crea gli indici del modello Beat mancanti (ix_beat_cat, titolo) su un database già esistente:
+    create_all non aggiunge indici a tabelle che esistono già. Idempotente, da eseguire all'avvio.
+    """
+    try:
+        for index in Beat.__table__.indexes:
+            index.create(bind=engine, checkfirst=True)
+        return True
+    except Exception as e:
+        logger.error(f"Errore creazione indici beats: {e}")
+        return False
+
 def initialize_database():
     """
     Inizializza il database creando tutte le tabelle necessarie.
@@ -873,41 +916,3 @@ def reserve_bundle_exclusive_beats_with_retry(bundle_id: int, user_id: int, rese
     # Se tutti i tentativi sono falliti
     logger.error(f"❌ All {max_retries} attempts failed for bundle {bundle_id} reservation")
     return False, "Bundle temporaneamente non disponibile, riprova tra qualche secondo"
-
-def release_bundle_reservations(bundle_id: int, user_id: int = None) -> int:
-    """
-    Rilascia le prenotazioni di tutti i beat esclusivi in un bundle.
-    Se user_id è specificato, rilascia solo se i beat sono prenotati da quell'utente.
-    
-    Returns:
-        int: Numero di prenotazioni rilasciate
-    """
-    with SessionLocal() as session:
-        try:
-            # Trova tutti i beat esclusivi nel bundle che sono prenotati
-            exclusive_beats = session.query(Beat).join(BundleBeat).filter(
-                BundleBeat.bundle_id == bundle_id,
-                Beat.is_exclusive == 1,
-                Beat.reserved_by_user_id.isnot(None)
-            ).all()
-            
-            released_count = 0
-            
-            for beat in exclusive_beats:
-                # Se è specificato un user_id, controlla che coincida
-                if user_id is None or beat.reserved_by_user_id == user_id:
-                    beat.reserved_by_user_id = None
-                    beat.reserved_at = None
-                    beat.reservation_expires_at = None
-                    released_count += 1
-            
-            if released_count > 0:
-                session.commit()
-                logger.info(f"✅ Rilasciate {released_count} prenotazioni bundle {bundle_id} per utente {user_id}")
-            
-            return released_count
-            
-        except Exception as e:
-            logger.error(f"❌ Errore rilascio prenotazioni bundle {bundle_id}: {e}")
-            session.rollback()
-            return 0
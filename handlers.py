@@ -13,6 +13,37 @@ from callbacks import (
     handle_wrong_input  # <--- aggiungi questa importazione
 )
 
+# Filtro composto una sola volta all'import: qualsiasi messaggio che non sia un comando
+NON_COMMAND_FILTER = filters.ALL & ~filters.COMMAND
+
+# Routing dei callback in BEAT_SELECTION: lookup esatto nel dict, poi prefissi
+BEAT_SELECTION_ROUTES = {
+    **dict.fromkeys(
+        ("prev", "next", "preview", "buy", "menu", "disabled_prev", "disabled_next",
+         "change_filters", "remove_all_filters"),
+        handle_beat_navigation,
+    ),
+    **dict.fromkeys(
+        ("filter_genre", "filter_mood", "filter_price", "back_to_filters",
+         "remove_genre", "remove_mood", "remove_price", "apply_filters", "cancel_filters"),
+        handle_filter_selection,
+    ),
+}
+BEAT_FILTER_PREFIXES = ("select_genre_", "select_mood_", "select_price_", "disabled_")
+
+async def route_beat_selection(update, context):
+    """Smista i callback dello stato BEAT_SELECTION senza valutare espressioni regolari"""
+    data = update.callback_query.data or ""
+    handler = BEAT_SELECTION_ROUTES.get(data)
+    if handler is None and data.startswith(BEAT_FILTER_PREFIXES):
+        handler = handle_filter_selection
+    if handler is None:
+        return None  # Callback sconosciuto: lo stato resta invariato
+    return await handler(update, context)
+
+# Callback ammessi in BUNDLE_SELECTION: insieme chiuso, basta un lookup nel frozenset
+BUNDLE_NAV_KEYS = frozenset({"bundle_prev", "bundle_next", "bundle_preview", "bundle_buy", "menu"})
+
 conversation_handler = ConversationHandler(
     entry_points=[CommandHandler("start", start_command)],
     states={
@@ -20,18 +51,14 @@ conversation_handler = ConversationHandler(
         GENRE: [CallbackQueryHandler(genre_selected)],
         MOOD: [CallbackQueryHandler(mood_selected)],
         BEAT_SELECTION: [
-            CallbackQueryHandler(handle_beat_navigation, pattern="^(prev|next|preview|buy|menu|disabled_prev|disabled_next|change_filters|remove_all_filters)$"),
-            CallbackQueryHandler(
-                handle_filter_selection,
-                pattern="^(filter_genre|filter_mood|filter_price|back_to_filters|select_genre_.*|select_mood_.*|select_price_.*|remove_genre|remove_mood|remove_price|apply_filters|cancel_filters|disabled_.*|change_filters)$"
-            ),
+            CallbackQueryHandler(route_beat_selection),
         ],
         BUNDLE_SELECTION: [
-            CallbackQueryHandler(handle_bundle_navigation, pattern="^(bundle_prev|bundle_next|bundle_preview|bundle_buy|menu)$"),
+            CallbackQueryHandler(handle_bundle_navigation, pattern=BUNDLE_NAV_KEYS.__contains__),
         ],
     },
     fallbacks=[
-        MessageHandler(filters.ALL & ~filters.COMMAND, handle_wrong_input),
+        MessageHandler(NON_COMMAND_FILTER, handle_wrong_input),
     ],
     allow_reentry=True
 )
\ No newline at end of file
@@ -1,11 +1,16 @@
 #utils.py
 import os
+import asyncio
+import logging
 import time
-import requests
 import httpx
-import boto3
-from botocore.client import Config
+from cachetools import TTLCache
+import hmac
+import hashlib
+from datetime import datetime, timezone
+from urllib.parse import urlparse, quote
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy import select, func
 from db_manager import SessionLocal, Beat
 from config import (
     get_paypal_config, 
@@ -15,6 +20,8 @@ from config import (
     print_config_summary
 )
 
+logger = logging.getLogger(__name__)
+
 # Configurazione dinamica basata su ambiente
 PAYPAL_CONFIG = get_paypal_config()
 R2_CONFIG = get_r2_config()
@@ -26,9 +33,9 @@ def get_internal_token():
     """
     from config import get_internal_config
     internal_config = get_internal_config()
-    if internal_config["bot_url"] and not internal_config["token"]:
+    if internal_config.bot_url and not internal_config.token:
         raise RuntimeError("INTERNAL_TOKEN non impostato nelle variabili di ambiente!")
-    return internal_config["token"]
+    return internal_config.token
 
 def get_bot_internal_url():
     """
@@ -36,24 +43,34 @@ def get_bot_internal_url():
     """
     from config import get_internal_config
     internal_config = get_internal_config()
-    if internal_config["bot_url"]:
-        return internal_config["bot_url"]
+    if internal_config.bot_url:
+        return internal_config.bot_url
     return "http://localhost:8000"
 
 # Configurazioni PayPal dinamiche
-PAYPAL_CLIENT_ID = PAYPAL_CONFIG["client_id"]
-PAYPAL_CLIENT_SECRET = PAYPAL_CONFIG["client_secret"]
-PAYPAL_API_BASE_URL = PAYPAL_CONFIG["api_base"]
+PAYPAL_CLIENT_ID = PAYPAL_CONFIG.client_id
+PAYPAL_CLIENT_SECRET = PAYPAL_CONFIG.client_secret
+PAYPAL_API_BASE_URL = PAYPAL_CONFIG.api_base
 PAYPAL_OAUTH_URL = f"{PAYPAL_API_BASE_URL}/v1/oauth2/token"
 PAYPAL_ORDER_URL = f"{PAYPAL_API_BASE_URL}/v2/checkout/orders"
 
-def validate_url(url):
-    """Check if URL is accessible and returns image"""
+# Client HTTP condiviso per i controlli degli URL: riusa le connessioni keep-alive
+URL_CHECK_TIMEOUT = 5  # secondi
+_URL_CHECK_CLIENT = None
+
+def _get_url_check_client():
+    global _URL_CHECK_CLIENT
+    if _URL_CHECK_CLIENT is None or _URL_CHECK_CLIENT.is_closed:
+        _URL_CHECK_CLIENT = httpx.AsyncClient(timeout=URL_CHECK_TIMEOUT)
+    return _URL_CHECK_CLIENT
+
+async def validate_url(url):
+    """Check if URL is accessible and returns image (HEAD asincrona: non blocca l'event loop)"""
     if not url:
         return False
         
     try:
-        response = requests.head(url, timeout=5)
+        response = await _get_url_check_client().head(url)
         content_type = response.headers.get('Content-Type', '')
         return response.status_code == 200 and 'image' in content_type
     except Exception:
@@ -88,19 +105,42 @@ def build_keyboard(items, back_button=False):
 
 
 def get_beat_counts():
-    session = SessionLocal()
+    """Conteggi per (genere, mood) e per genere con un solo GROUP BY, senza caricare oggetti Beat"""
+    stmt = select(Beat.genre, Beat.mood, func.count()).group_by(Beat.genre, Beat.mood)
+    with SessionLocal() as session:
+        rows = session.execute(stmt).all()
     counts = {}
-    for beat in session.query(Beat).all():
-        key = (beat.genre, beat.mood)
-        counts[key] = counts.get(key, 0) + 1
     genre_counts = {}
-    for beat in session.query(Beat).all():
-        genre_counts[beat.genre] = genre_counts.get(beat.genre, 0) + 1
-    session.close()
+    for genre, mood, n in rows:
+        counts[(genre, mood)] = n
+        genre_counts[genre] = genre_counts.get(genre, 0) + n
     return counts, genre_counts
 
 
+# Mappa genere -> mood ricalcolata al massimo ogni 30 secondi invece che a ogni click
+GENRE_MOODS_CACHE_TTL = 30  # secondi
+_GENRE_MOOD_CACHE = TTLCache(maxsize=1, ttl=GENRE_MOODS_CACHE_TTL)
+
+def invalidate_genre_to_moods_cache():
+    """Forza il ricalcolo della mappa genere -> mood (dopo modifiche al catalogo)"""
+    _GENRE_MOOD_CACHE.clear()
+
 def build_dynamic_genre_to_moods():
+    """Restituisce la mappa genere -> mood (condivisa: i chiamanti non devono modificarla)"""
+    result = _GENRE_MOOD_CACHE.get("v")
+    if result is None:
+        result = _GENRE_MOOD_CACHE["v"] = _build_genre_to_moods()
+    return result
+
+async def get_genre_to_moods():
+    """Come build_dynamic_genre_to_moods, ma in caso di cache scaduta la query gira in un thread"""
+    result = _GENRE_MOOD_CACHE.get("v")
+    if result is None:
+        result = await asyncio.to_thread(_build_genre_to_moods)
+        _GENRE_MOOD_CACHE["v"] = result
+    return result
+
+def _build_genre_to_moods():
     base = {
         "Trap":           ["Hard", "Love", "Sad", "Dark"],
         "Hip-Hop":        ["Hard", "Love", "Chill", "Epic"],
@@ -163,6 +203,29 @@ async def show_loading(query):
         pass  # Ignora errori se il markup non può essere editato
 
 
+# Redis opzionale (stato condiviso tra istanze): attivo solo se REDIS_URL è impostato
+REDIS_URL = get_env_var("REDIS_URL")
+# Timeout di connessione e di risposta: un Redis bloccato non deve bloccare gli handler
+REDIS_TIMEOUT = 2  # secondi
+_REDIS_CLIENT = None
+_REDIS_MISSING = False  # Import già fallito: non si riprova e non si ripete l'avviso
+
+def get_redis():
+    """Client Redis asincrono condiviso, None se REDIS_URL non è impostato o il pacchetto manca"""
+    global _REDIS_CLIENT, _REDIS_MISSING
+    if _REDIS_CLIENT is None and REDIS_URL and not _REDIS_MISSING:
+        try:
+            # Import locale: senza REDIS_URL il pacchetto redis non viene mai caricato
+            import redis.asyncio as aioredis
+        except ImportError:
+            _REDIS_MISSING = True
+            logger.warning("REDIS_URL impostato ma il pacchetto redis non è installato: uso lo stato locale")
+            return None
+        _REDIS_CLIENT = aioredis.from_url(
+            REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT
+        )
+    return _REDIS_CLIENT
+
 def is_user_blocked(context):
     """Restituisce True se l'utente è bloccato, False altrimenti."""
     now = time.time()
@@ -251,35 +314,69 @@ async def create_paypal_order(custom_id: str, amount: float, description: str, c
 
     raise Exception("No approval URL found in PayPal order response")
 
-def generate_r2_signed_url(key: str, expires_in: int = 3600) -> str:
-    # Configurazioni R2 dinamiche
-    R2_ACCESS_KEY_ID = R2_CONFIG["access_key_id"]
-    R2_SECRET_ACCESS_KEY = R2_CONFIG["secret_access_key"]
-    R2_ENDPOINT_URL = R2_CONFIG["endpoint_url"]
-    R2_BUCKET_NAME = R2_CONFIG["bucket_name"]
-    R2_PUBLIC_BASE_URL = R2_CONFIG["public_base_url"]
-    
-    session = boto3.session.Session()
-    s3 = session.client(
-        service_name="s3",
-        aws_access_key_id=R2_ACCESS_KEY_ID,
-        aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-        endpoint_url=R2_ENDPOINT_URL,
-        config=Config(signature_version="s3v4"),
-        region_name="auto"
+# Firma SigV4 manuale per R2: endpoint, bucket e regione sono fissi, quindi non serve botocore
+_R2_REGION = "auto"
+_R2_SERVICE = "s3"
+_R2_HOST = urlparse(R2_CONFIG.endpoint_url or "").netloc
+_R2_CREDENTIAL_KEY = quote(R2_CONFIG.access_key_id or "", safe="")
+_R2_SECRET_KEY = ("AWS4" + (R2_CONFIG.secret_access_key or "")).encode("utf-8")
+
+# Parti fisse dell'URL e della richiesta canonica: a ogni firma restano solo data, chiave e scadenza
+_R2_SCOPE_SUFFIX = f"/{_R2_REGION}/{_R2_SERVICE}/aws4_request"
+_R2_QUERY_PREFIX = (
+    "X-Amz-Algorithm=AWS4-HMAC-SHA256"
+    f"&X-Amz-Credential={_R2_CREDENTIAL_KEY}%2F"
+)
+_R2_QUOTED_SCOPE_SUFFIX = quote(_R2_SCOPE_SUFFIX, safe="")
+_R2_CANONICAL_URI_PREFIX = f"GET\n/{R2_CONFIG.bucket_name}/"
+_R2_CANONICAL_HEADERS = f"\nhost:{_R2_HOST}\n\nhost\nUNSIGNED-PAYLOAD"
+_R2_PUBLIC_URL_PREFIX = f"{R2_CONFIG.public_base_url}/"
+
+# Chiave di firma derivata: dipende solo dalla data UTC, quindi si ricalcola una volta al giorno
+_signing_key_cache = (None, None)
+
+def _hmac_sha256(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+def _get_signing_key(date_stamp: str) -> bytes:
+    global _signing_key_cache
+    cached_date, cached_key = _signing_key_cache
+    if cached_date == date_stamp:
+        return cached_key
+    signing_key = _hmac_sha256(_R2_SECRET_KEY, date_stamp)
+    signing_key = _hmac_sha256(signing_key, _R2_REGION)
+    signing_key = _hmac_sha256(signing_key, _R2_SERVICE)
+    signing_key = _hmac_sha256(signing_key, "aws4_request")
+    _signing_key_cache = (date_stamp, signing_key)
+    return signing_key
+
+def sign_r2_url(key: str, expires_in: int = 3600) -> str:
+    """
+    Calcola la query string firmata (SigV4, UNSIGNED-PAYLOAD) per una GET su R2
+    e restituisce l'URL pubblico corrispondente.
+    """
+    now = datetime.now(timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date_stamp = amz_date[:8]
+    credential_scope = date_stamp + _R2_SCOPE_SUFFIX
+
+    key_path = quote(key, safe="/")
+    # Parametri già in ordine alfabetico, come richiesto dalla forma canonica
+    canonical_query = (
+        f"{_R2_QUERY_PREFIX}{date_stamp}{_R2_QUOTED_SCOPE_SUFFIX}"
+        f"&X-Amz-Date={amz_date}"
+        f"&X-Amz-Expires={int(expires_in)}"
+        "&X-Amz-SignedHeaders=host"
     )
-    url = s3.generate_presigned_url(
-        ClientMethod='get_object',
-        Params={'Bucket': R2_BUCKET_NAME, 'Key': key},
-        ExpiresIn=expires_in
+    canonical_request = f"{_R2_CANONICAL_URI_PREFIX}{key_path}\n{canonical_query}{_R2_CANONICAL_HEADERS}"
+    string_to_sign = (
+        f"AWS4-HMAC-SHA256\n{amz_date}\n{credential_scope}\n"
+        f"{hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()}"
     )
-    from urllib.parse import urlparse
-    parsed = urlparse(url)
-    path_parts = parsed.path.split('/', 2)
-    if len(path_parts) == 3:
-        key_path = path_parts[2]
-    else:
-        key_path = parsed.path.lstrip('/')
-    signed_url = f"{R2_PUBLIC_BASE_URL}/{key_path}?{parsed.query}"
-    return signed_url
+
+    signature = hmac.new(_get_signing_key(date_stamp), string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    return f"{_R2_PUBLIC_URL_PREFIX}{key_path}?{canonical_query}&X-Amz-Signature={signature}"
+
+def generate_r2_signed_url(key: str, expires_in: int = 3600) -> str:
+    return sign_r2_url(key, expires_in)
 